@@ -1,17 +1,49 @@
 import os
+import re
 import sys
+import time
 import redis
-import requests
 import io
-import base64
 import qrcode
-from PIL import Image, ImageOps
-from flask import Flask, render_template_string, Response, stream_with_context
-from datetime import datetime
+import renditions
+import selection
+import photos
+import geocoder
+import weather
+from flask import Flask, render_template, Response, send_file, request, jsonify
+from urllib.parse import quote
+from functools import lru_cache
+from datetime import datetime, timezone
 
 app = Flask(__name__)
+# Static files are versioned with ?v=<APP_VERSION>, so browsers may keep them for a year
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
 r = redis.Redis(host=os.getenv('REDIS_HOST'), port=6379, decode_responses=True)
 
+# Number of upcoming photos kept selected (and rendered by the worker) per display
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', '3'))
+
+RELOAD_INTERVAL = int(os.getenv('APP_RELOAD_INTERVAL', '30'))
+QUIET_TIME = os.getenv('APP_QUIET_TIME', '')
+SHOW_QR_CODE = os.getenv('SHOW_QR_CODE', 'false').lower() == 'true'
+# Nextcloud web UI base URL, derived from the WebDAV URL
+NC_BASE_URL = os.getenv('NC_URL', '').rstrip('/').split('/remote.php')[0]
+
+# Number of recently shown photos per display that are not picked again
+DISPLAY_HISTORY = int(os.getenv('DISPLAY_HISTORY', '100'))
+
+# Displays seen within DISPLAY_IDLE seconds, at most MAX_DISPLAYS of them (the most
+# recent), are tracked in the displays:active zset and avoid each other's photos
+DISPLAY_IDLE = 86400
+MAX_DISPLAYS = 32
+
+# Photo shapes shown by each display: DISPLAY_ASPECT for all of them, DISPLAY_PROFILES
+# per display (e.g. "kitchen=portrait;hall=landscape,panorama"), ?aspect= overrides both
+DISPLAY_ASPECT = os.getenv('DISPLAY_ASPECT', '')
+DISPLAY_PROFILES = dict(
+    entry.split('=', 1) for entry in os.getenv('DISPLAY_PROFILES', '').replace(' ', '').split(';') if '=' in entry
+)
+
 # Translations
 TRANSLATIONS = {
     'en': {
@@ -44,406 +76,313 @@ TRANSLATIONS = {
     }
 }
 
-@app.route('/')
-def index():
-    lang = os.getenv('APP_LANG', 'en')
-    t = TRANSLATIONS.get(lang, TRANSLATIONS['en'])
+def get_display_id():
+    # Each frame identifies itself with ?display=<name>; frames without one share "default"
+    display = re.sub(r'[^A-Za-z0-9_-]', '', request.args.get('display', ''))[:32]
+    return display or 'default'
 
-    # Pick random photo based on weight from Redis
-    photo_key = r.zrandmember("photo_pool")
-    if not photo_key:
-        return "No photos found in pool. Please wait for the scanner to populate the database."
-        
-    data = r.hgetall(photo_key)
+def get_display_aspects(display):
+    # Aspect classes this display shows, None for all photos
+    value = request.args.get('aspect') or DISPLAY_PROFILES.get(display) or DISPLAY_ASPECT
+    aspects = [a for a in value.lower().split(',') if a in selection.ASPECTS]
+    return aspects or None
+
+def pick_photos(count, aspects=None, exclude=None):
+    # Weighted by the configured policy (WEIGHT_POLICY), including the "on this day" bonus
+    return selection.pick(r, count, aspects=aspects, exclude=exclude)
+
+# Everything a page request reads, in one round trip: takes the head of the display's
+# prefetch queue (skipping photos deleted since they were queued) and returns its
+# record, the record of the photo after it, the ids to exclude from new picks (this
+# display's history plus whatever any display shows or has queued) and the overlay state.
+# The pick that refills the queue stays in selection.py and costs two more round trips.
+# Besides its KEYS, the script reads displays:active, display:*, prefetch:*, photo:rec:*
+# and the overlay keys, which only works on a single Redis instance (not Redis Cluster).
+TAKE_NEXT = r.register_script("""
+local queue, history, attempts = KEYS[1], KEYS[2], tonumber(ARGV[1])
+local prefix, bucket_size = ARGV[3], tonumber(ARGV[4])
+
+-- Packed record of a photo id (see photos.py), hex encoded so the reply stays valid UTF-8
+local function record(id)
+    local n = tonumber(id)
+    if not n then return false end
+    local raw = redis.call('HGET', prefix .. string.format('%d', math.floor(n / bucket_size)),
+                           string.format('%d', n % bucket_size))
+    if not raw then return false end
+    return (string.gsub(raw, '.', function(c) return string.format('%02x', string.byte(c)) end))
+end
+
+local photo, data = false, false
+for _ = 1, attempts do
+    photo = redis.call('LPOP', queue)
+    if not photo then break end
+    data = record(photo)
+    if data then break end
+end
+if not data then photo = false end
+local next_photo = redis.call('LINDEX', queue, 0)
+local next_data = next_photo and record(next_photo) or false
+
+local excluded = redis.call('LRANGE', history, 0, -1)
+-- Display names come from the query string: forget idle ones and keep only the most
+-- recently seen, so made-up names cannot make every request slower
+redis.call('ZREMRANGEBYSCORE', 'displays:active', '-inf', tonumber(ARGV[5]) - tonumber(ARGV[6]))
+redis.call('ZREMRANGEBYRANK', 'displays:active', 0, -tonumber(ARGV[7]) - 1)
+local displays = redis.call('ZRANGE', 'displays:active', 0, -1)
+table.insert(displays, ARGV[2])
+for _, display in ipairs(displays) do
+    local current = redis.call('HGET', 'display:' .. display, 'current')
+    if current then table.insert(excluded, current) end
+    for _, key in ipairs(redis.call('LRANGE', 'prefetch:' .. display, 0, -1)) do
+        table.insert(excluded, key)
+    end
+end
+
+local overlay = redis.call('MGET', 'scanner:status', 'weather:data', 'stats:last_scan_time')
+return {photo, data, excluded, redis.call('LLEN', queue), next_photo or false, next_data,
+        redis.call('ZCARD', 'photo_pool'), overlay[1] or false, overlay[2] or false, overlay[3] or false}
+""")
+
+def next_photo(display):
+    # Take the head of this display's prefetch queue (already rendered by the worker)
+    # and top the queue back up so the following photos are ready in advance.
+    # Returns the photo record, the path of the photo after it and the overlay state.
+    queue = f"prefetch:{display}"
+    aspects = get_display_aspects(display)
+    (photo_id, raw, exclude, queued, next_id, next_raw, total_photos,
+     scanner_status, weather_raw, last_scan_time) = TAKE_NEXT(
+        keys=[queue, f"history:{display}"],
+        args=[PREFETCH_DEPTH + 1, display, photos.RECORD_PREFIX, photos.BUCKET_SIZE,
+              int(time.time()), DISPLAY_IDLE, MAX_DISPLAYS])
+    data, next_data = photos.decode(r, [(photo_id, raw and bytes.fromhex(raw)),
+                                        (next_id, next_raw and bytes.fromhex(next_raw))])
+    overlay = {
+        'total_photos': total_photos,
+        'scanner_status': scanner_status or "idle",
+        'weather': weather.decode(weather_raw) if weather.enabled() else None,
+        'last_scan_time': last_scan_time,
+    }
+
+    if not data:
+        # Queue empty (new display) or only stale entries
+        picked = pick_photos(1, aspects, exclude)
+        photo_id = picked[0] if picked else None
+        data = photos.get(r, [photo_id])[0] if photo_id else None
+    if photo_id:
+        exclude.append(photo_id)
+
+    pipe = r.pipeline(transaction=False)
+    missing = PREFETCH_DEPTH - queued
+    if missing > 0:
+        picks = pick_photos(missing, aspects, exclude)
+        if picks:
+            if not next_data:
+                next_data = photos.get(r, picks[:1])[0]
+            pipe.rpush(queue, *picks)
+            pipe.expire(queue, 86400)
+            pipe.rpush("render:queue", *picks)
+            pipe.ltrim("render:queue", -1000, -1)
+
+    if data:
+        # Per-display session state and counters, written in the same round trip
+        history = f"history:{display}"
+        pipe.lpush(history, photo_id)
+        pipe.ltrim(history, 0, DISPLAY_HISTORY - 1)
+        pipe.expire(history, 7 * 86400)
+        now = int(time.time())
+        pipe.hset(f"display:{display}", mapping={"current": photo_id, "last_seen": now})
+        pipe.hincrby(f"display:{display}", "shown", 1)
+        pipe.expire(f"display:{display}", DISPLAY_IDLE)
+        pipe.zadd("displays:active", {display: now})
+    pipe.execute()
+
+    next_path = next_data['path'] if next_data else None
+    return data, next_path, overlay
+
+def nextcloud_link(file_id):
+    # Nextcloud /f/ID is the most robust internal redirect link to the web UI
+    return f"{NC_BASE_URL}/index.php/f/{file_id}"
+
+@lru_cache(maxsize=512)
+def qr_png(link):
+    qr = qrcode.QRCode(box_size=3, border=1)
+    qr.add_data(link)
+    qr.make(fit=True)
+    img_io = io.BytesIO()
+    qr.make_image(fill_color="white", back_color="transparent").save(img_io, format="PNG")
+    return img_io.getvalue()
+
+def build_slide(display, t):
+    # Everything the frame needs to show one photo; rendered into the page by index()
+    # and returned as JSON by /api/next for in-place transitions.
+    data, next_path, overlay = next_photo(display)
+    if not data:
+        return None
     
-    # Parse Date
-    date_obj = None
-    if data.get('timestamp') and data['timestamp'] != 'Unknown':
-        try:
-            date_obj = datetime.strptime(data['timestamp'], "%Y:%m:%d %H:%M:%S")
-        except ValueError:
-            pass
+    # Capture date (EXIF local time, stored as if it were UTC)
+    date_obj = datetime.fromtimestamp(data['epoch'], timezone.utc) if data['epoch'] else None
             
     month_str = t['months'][date_obj.month - 1] if date_obj else ""
     year_str = date_obj.strftime("%Y") if date_obj else ""
     
-    # Parse Location (Folder name as proxy)
-    location_str = ""
-    try:
-        folder_name = os.path.basename(os.path.dirname(data['path']))
-        # Optional: Clean up date prefix from folder name if present (e.g. "2009-05-24 Berliner Zoo" -> "Berliner Zoo")
-        parts = folder_name.split(' ', 1)
-        if len(parts) > 1 and any(char.isdigit() for char in parts[0]):
-             location_str = parts[1]
-        else:
-             location_str = folder_name
-    except:
-        location_str = "Unknown Location"
-
-    scanner_status = r.get("scanner:status") or "idle"
-
-    # Weather Logic
-    weather_data = None
-    lat = os.getenv('WEATHER_LAT')
-    lon = os.getenv('WEATHER_LON')
-    
-    if lat and lon:
+    # Location: place name from the GPS position, folder name as fallback
+    location_str = data.get('place') or ""
+    if not location_str and data.get('gps'):
+        # Records scanned before reverse geocoding was available: look up once and keep it
+        place = geocoder.lookup(*data['gps'])
+        if place:
+            location_str = place[0]
+            photos.update(r, data['id'], place=place[0], country=place[1])
+    if not location_str:
         try:
-            # Check cache first (15 min cache)
-            cached_weather = r.get("weather:data")
-            if cached_weather:
-                import json
-                weather_data = json.loads(cached_weather)
+            folder_name = os.path.basename(os.path.dirname(data['path']))
+            # Optional: Clean up date prefix from folder name if present (e.g. "2009-05-24 Berliner Zoo" -> "Berliner Zoo")
+            parts = folder_name.split(' ', 1)
+            if len(parts) > 1 and any(char.isdigit() for char in parts[0]):
+                 location_str = parts[1]
             else:
-                # Fetch from Open-Meteo
-                url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,weather_code&daily=weather_code,temperature_2m_max,temperature_2m_min&timezone=auto&forecast_days=2"
-                resp = requests.get(url, timeout=5)
-                if resp.status_code == 200:
-                    w = resp.json()
-                    
-                    # WMO Weather Codes mapping (simplified)
-                    def get_icon(code):
-                        if code == 0: return "☀️"
-                        if code in [1,2,3]: return "⛅"
-                        if code in [45,48]: return "🌫️"
-                        if code in [51,53,55,61,63,65]: return "🌧️"
-                        if code in [71,73,75,77]: return "❄️"
-                        if code in [95,96,99]: return "⛈️"
-                        return "🌡️"
-
-                    current_temp = round(w['current']['temperature_2m'])
-                    current_icon = get_icon(w['current']['weather_code'])
-                    
-                    # Tomorrow
-                    tomorrow_max = round(w['daily']['temperature_2m_max'][1])
-                    tomorrow_min = round(w['daily']['temperature_2m_min'][1])
-                    tomorrow_icon = get_icon(w['daily']['weather_code'][1])
-                    
-                    weather_data = {
-                        'current': {'temp': current_temp, 'icon': current_icon},
-                        'tomorrow': {'max': tomorrow_max, 'min': tomorrow_min, 'icon': tomorrow_icon}
-                    }
-                    
-                    # Cache for 15 mins
-                    import json
-                    r.setex("weather:data", 900, json.dumps(weather_data))
-        except Exception as e:
-            print(f"Weather error: {e}")
-
-    # QR Code Logic
-    qr_code_b64 = None
-    nextcloud_link = "#"
-    if os.getenv('SHOW_QR_CODE', 'false').lower() == 'true':
-        try:
-            nc_url = os.getenv('NC_URL', '').rstrip('/')
-            # Try to determine base URL
-            base_url = nc_url
-            if '/remote.php' in nc_url:
-                base_url = nc_url.split('/remote.php')[0]
-            
-            # Extract folder and filename
-            # data['path'] is usually something like /Photos/Album/img.jpg in WebDAV
-            file_path = data.get('path', '')
-            if file_path:
-                directory = os.path.dirname(file_path)
-                filename = os.path.basename(file_path)
-                
-                # Construct UI Link using File ID if available
-                from urllib.parse import quote
-                file_id = data.get('file_id')
-                if file_id:
-                    # Nextcloud /f/ID is the most robust internal redirect link
-                    nextcloud_link = f"{base_url}/index.php/f/{file_id}"
-                else:
-                    # Fallback for older scans without file_id
-                    nextcloud_link = f"{base_url}/index.php/apps/files/?dir={quote(directory)}&scrollto={quote(filename)}"
-                
-                import sys
-                print(f"DEBUG: Nextcloud Link Generated: {nextcloud_link}", file=sys.stderr)
-                sys.stderr.flush()
-                
-                # Generate QR
-                qr = qrcode.QRCode(box_size=3, border=1)
-                qr.add_data(nextcloud_link)
-                qr.make(fit=True)
-                
-                img_io = io.BytesIO()
-                qr_img = qr.make_image(fill_color="white", back_color="transparent")
-                qr_img.save(img_io, format="PNG")
-                img_io.seek(0)
-                qr_code_b64 = base64.b64encode(img_io.getvalue()).decode()
-        except Exception as e:
-             print(f"QR Gen Error: {e}")
-
-    total_photos = r.zcard("photo_pool") or 0
-    last_scan_time = r.get("stats:last_scan_time")
+                 location_str = folder_name
+        except:
+            location_str = "Unknown Location"
+
+    # QR code: the page links to /qr/<file_id>, rendered once per file and cached by the browser.
+    # Every scan stores the file id, so records without one are skipped.
+    qr = None
+    if SHOW_QR_CODE and data.get('file_id'):
+        qr = {'image': f"/qr/{data['file_id']}", 'link': nextcloud_link(data['file_id'])}
+
     last_scan_str = ""
-    if last_scan_time:
+    if overlay['last_scan_time']:
         try:
-            dt = datetime.fromisoformat(last_scan_time)
+            dt = datetime.fromisoformat(overlay['last_scan_time'])
             last_scan_str = dt.strftime("%d.%m %H:%M")
         except:
             pass
 
-    return render_template_string("""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body, html { margin: 0; padding: 0; height: 100%; overflow: hidden; background: #000; font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; color: white; }
-                .container { position: relative; width: 100%; height: 100%; display: flex; justify-content: center; align-items: center; }
-                .background {
-                    position: absolute; top: 0; left: 0; width: 100%; height: 100%;
-                    background-image: url('/image{{ data.path }}');
-                    background-size: cover;
-                    background-position: center;
-                    filter: blur(25px) brightness(0.5);
-                    z-index: 1;
-                    transform: scale(1.1); /* Prevent blur edges */
-                }
-                .photo {
-                    position: relative;
-                    max-width: 95%;
-                    max-height: 95%;
-                    z-index: 2;
-                    box-shadow: 0 0 30px rgba(0,0,0,0.7);
-                }
-                .overlay-top-right {
-                    position: absolute; top: 30px; right: 40px; z-index: 3;
-                    display: flex; flex-direction: column; align-items: flex-end;
-                }
-                .clock {
-                    font-size: 3em; font-weight: 300;
-                    text-shadow: 2px 2px 4px rgba(0,0,0,0.8);
-                    font-family: monospace;
-                }
-                .version-badge {
-                    position: absolute; top: 10px; left: 10px; z-index: 3;
-                    opacity: 0.3; font-size: 0.7em; font-family: monospace;
-                    transition: opacity 0.3s;
-                }
-                .version-badge:hover { opacity: 0.8; }
-                .weather-container {
-                    margin-top: 10px;
-                    display: flex;
-                    flex-direction: column;
-                    align-items: flex-end;
-                    text-shadow: 1px 1px 3px rgba(0,0,0,0.8);
-                    font-size: 2.5em;
-                }
-                .weather-row { display: flex; gap: 10px; align-items: center; }
-                .weather-label { font-size: 0.7em; opacity: 0.8; margin-right: 5px; }
-                
-                .overlay-bottom-left {
-                    position: absolute; bottom: 40px; left: 40px; z-index: 3;
-                    text-shadow: 2px 2px 4px rgba(0,0,0,0.8);
-                    display: flex; flex-direction: column;
-                    align-items: flex-start;
-                }
-                .meta-row { display: flex; align-items: baseline; }
-                .camera-icon { font-size: 1.2em; margin-right: 8px; }
-                .month { font-size: 1.5em; font-weight: 600; text-transform: uppercase; margin-right: 10px; }
-                .year-row { display: flex; align-items: baseline; margin-top: -10px; }
-                .year { font-size: 5em; font-weight: 700; line-height: 1; letter-spacing: -2px; }
-                .location { font-size: 2.5em; font-family: 'Georgia', serif; margin-left: 20px; font-weight: 400; }
-                .badges-container {
-                    position: absolute; bottom: 40px; right: 40px; z-index: 3;
-                    display: flex; flex-direction: column; align-items: flex-end; gap: 10px;
-                }
-                .status-badge {
-                    background-color: rgba(0, 0, 0, 0.6);
-                    padding: 8px 12px;
-                    border-radius: 20px;
-                    font-size: 0.9em;
-                    display: flex;
-                    align-items: center;
-                    gap: 8px;
-                    backdrop-filter: blur(5px);
-                    border: 1px solid rgba(255,255,255,0.1);
-                }
-                .status-dot {
-                    width: 8px;
-                    height: 8px;
-                    background-color: #4CAF50;
-                    border-radius: 50%;
-                    animation: pulse 1.5s infinite;
-                }
-                .qr-container {
-                    position: absolute; bottom: 120px; right: 40px; z-index: 3;
-                    opacity: 0.7; transition: opacity 0.3s;
-                }
-                .qr-container:hover { opacity: 1; }
-                .qr-img { border-radius: 8px; box-shadow: 0 4px 6px rgba(0,0,0,0.3); }
-                
-                @keyframes pulse {
-                    0% { opacity: 1; transform: scale(1); }
-                    50% { opacity: 0.5; transform: scale(0.8); }
-                    100% { opacity: 1; transform: scale(1); }
-                }
-            </style>
-            <script>
-                function updateTime() {
-                    const now = new Date();
-                    const hours = String(now.getHours()).padStart(2, '0');
-                    const minutes = String(now.getMinutes()).padStart(2, '0');
-                    document.getElementById('clock').textContent = hours + ':' + minutes;
-                }
-                setInterval(updateTime, 1000);
-                
-                // Configurable reload logic
-                const reloadInterval = {{ reload_interval * 1000 }};
-                const quietTime = "{{ quiet_time }}";
-
-                function checkReload() {
-                    if (!quietTime) {
-                        window.location.reload();
-                        return;
-                    }
-
-                    const now = new Date();
-                    const currentTime = now.getHours() * 60 + now.getMinutes();
-                    
-                    const ranges = quietTime.split(',');
-                    let isQuiet = false;
-
-                    for (const range of ranges) {
-                        const parts = range.trim().split('-');
-                        if (parts.length !== 2) continue;
-
-                        const [startH, startM] = parts[0].split(':').map(Number);
-                        const [endH, endM] = parts[1].split(':').map(Number);
-                        
-                        const start = startH * 60 + startM;
-                        const end = endH * 60 + endM;
-
-                        if (start <= end) {
-                            if (currentTime >= start && currentTime < end) {
-                                isQuiet = true;
-                                break;
-                            }
-                        } else {
-                            // Overnight range (e.g. 22:00-06:00)
-                            if (currentTime >= start || currentTime < end) {
-                                isQuiet = true;
-                                break;
-                            }
-                        }
-                    }
-
-                    if (!isQuiet) {
-                        window.location.reload();
-                    } else {
-                        // Check again after interval
-                        setTimeout(checkReload, reloadInterval);
-                    }
-                }
-
-                setTimeout(checkReload, reloadInterval);
-            </script>
-        </head>
-        <body onload="updateTime()">
-            <div class="container">
-                <div class="version-badge">{{ version }}</div>
-                <div class="background"></div>
-                <img src="/image{{ data.path }}" class="photo">
-                
-                <div class="overlay-top-right">
-                    <div id="clock" class="clock">--:--</div>
-                    {% if weather %}
-                    <div class="weather-container">
-                        <div class="weather-row">
-                            <span>{{ weather.current.icon }} {{ weather.current.temp }}°C</span>
-                        </div>
-                        <div class="weather-row" style="font-size: 0.8em; opacity: 0.9;">
-                            <span class="weather-label">{{ t.tom }}</span>
-                            <span>{{ weather.tomorrow.icon }} {{ weather.tomorrow.min }}° / {{ weather.tomorrow.max }}°</span>
-                        </div>
-                    </div>
-                    {% endif %}
-                </div>
-                
-                <div class="overlay-bottom-left">
-                    <div class="meta-row">
-                        <span class="camera-icon">📷</span>
-                        <span class="month">{{ month }}</span>
-                    </div>
-                    <div class="year-row">
-                        <span class="year">{{ year }}</span>
-                        <span class="location">{{ location }}</span>
-                    </div>
-                </div>
-
-                {% if qr_code %}
-                <div class="qr-container">
-                    <a href="{{ nc_link }}" target="_blank">
-                        <img src="data:image/png;base64,{{ qr_code }}" class="qr-img">
-                    </a>
-                </div>
-                {% endif %}
-
-                <div class="badges-container">
-                    <div class="status-badge">
-                        <span>{{ total_photos }} {{ t.photos }}</span>
-                    </div>
-                    
-                    {% if scanner_status == 'running' %}
-                    <div class="status-badge">
-                        <div class="status-dot"></div>
-                        <span>{{ t.indexing }}</span>
-                    </div>
-                    {% elif last_scan_str %}
-                    <div class="status-badge" style="opacity: 0.7;">
-                        <span>{{ t.index }} {{ last_scan_str }}</span>
-                    </div>
-                    {% endif %}
-                </div>
-            </div>
-        </body>
-        </html>
-    """, data=data, month=month_str, year=year_str, location=location_str, scanner_status=scanner_status, weather=weather_data, total_photos=total_photos, last_scan_str=last_scan_str, t=t, qr_code=qr_code_b64, nc_link=nextcloud_link, reload_interval=int(os.getenv('APP_RELOAD_INTERVAL', '30')), quiet_time=os.getenv('APP_QUIET_TIME', ''), version=os.getenv('APP_VERSION', 'unknown'))
+    return {
+        'photo': {
+            'path': data['path'],
+            'image': f"/image{quote(data['path'])}",
+            'background': f"/background{quote(data['path'])}",
+        },
+        'next': {
+            'image': f"/image{quote(next_path)}",
+            'background': f"/background{quote(next_path)}",
+        } if next_path else None,
+        'month': month_str,
+        'year': year_str,
+        'location': location_str,
+        # Weather is refreshed by the worker (weather.py); the request only reads the cache
+        'weather': overlay['weather'],
+        'qr': qr,
+        'total_photos': overlay['total_photos'],
+        'scanner_status': overlay['scanner_status'],
+        'last_scan': last_scan_str,
+        'version': os.getenv('APP_VERSION', 'unknown'),
+    }
+
+@app.route('/api/next')
+def api_next():
+    lang = os.getenv('APP_LANG', 'en')
+    t = TRANSLATIONS.get(lang, TRANSLATIONS['en'])
+
+    slide = build_slide(get_display_id(), t)
+    if not slide:
+        return jsonify({'error': 'No photos found in pool'}), 503
+    return jsonify(slide)
+
+@app.route('/')
+def index():
+    lang = os.getenv('APP_LANG', 'en')
+    t = TRANSLATIONS.get(lang, TRANSLATIONS['en'])
+
+    slide = build_slide(get_display_id(), t)
+    if not slide:
+        return "No photos found in pool. Please wait for the scanner to populate the database."
+
+    return render_template('index.html', slide=slide, t=t, reload_interval=RELOAD_INTERVAL, quiet_time=QUIET_TIME)
+
+def send_rendition(rendition):
+    if rendition.path is None:
+        return Response(rendition.data, content_type=rendition.mimetype)
+    return send_file(rendition.path, mimetype=rendition.mimetype, etag=rendition.key,
+                     conditional=True, max_age=renditions.MAX_AGE)
+
+def photo_source(filepath):
+    # (etag, file id) of an indexed photo, (None, None) for unknown paths
+    photo_id = photos.find(r, [filepath])[0]
+    record = photos.get(r, [photo_id])[0] if photo_id else None
+    if not record:
+        return None, None
+    return record['etag'] or None, record.get('file_id')
 
 @app.route('/image/<path:filepath>')
 def image_proxy(filepath):
     # Ensure filepath starts with / if it's missing
     if not filepath.startswith('/'):
         filepath = '/' + filepath
-        
-    nc_url = os.getenv('NC_URL', '').rstrip('/')
-    full_url = f"{nc_url}{filepath}"
-    
+
     try:
-        # Fetch image from Nextcloud
-        resp = requests.get(full_url, auth=(os.getenv('NC_USER'), os.getenv('NC_PASS')), stream=True)
-        resp.raise_for_status()
-        
-        # Open image and apply EXIF rotation (requires loading into memory)
-        # Note: We must load the image to process EXIF/rotation
-        image = Image.open(io.BytesIO(resp.content))
-        image = ImageOps.exif_transpose(image)
-        
-        # Save to buffer
-        img_io = io.BytesIO()
-        fmt = image.format or 'JPEG'
-        image.save(img_io, format=fmt, quality=85)
-        img_io.seek(0)
-        
-        return Response(img_io, content_type=f'image/{fmt.lower()}')
+        # Display-sized, pre-rotated rendition from the local cache (keyed by path + etag)
+        etag, file_id = photo_source(filepath)
+        rendition = renditions.get_rendition(filepath, etag, file_id=file_id)
     except Exception as e:
         print(f"Error fetching image {filepath}: {e}", file=sys.stderr)
         return "Not Found", 404
 
+    return send_rendition(rendition)
+
+@app.route('/background/<path:filepath>')
+def background_proxy(filepath):
+    if not filepath.startswith('/'):
+        filepath = '/' + filepath
+
+    try:
+        # Tiny pre-blurred, darkened thumbnail so the frame does not blur a full-size image
+        etag, file_id = photo_source(filepath)
+        rendition = renditions.get_background(filepath, etag, file_id)
+    except Exception as e:
+        print(f"Error fetching background {filepath}: {e}", file=sys.stderr)
+        return "Not Found", 404
+
+    return send_rendition(rendition)
+
+@app.route('/qr/<file_id>')
+def qr_code(file_id):
+    if not SHOW_QR_CODE or not file_id.isdigit():
+        return "Not found", 404
+    resp = Response(qr_png(nextcloud_link(file_id)), mimetype='image/png')
+    # The link for a file id never changes
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
 @app.route('/info')
 def info():
     total_photos = r.zcard("photo_pool")
     last_scan_found = r.get("stats:last_scan_found") or 0
     last_scan_processed = r.get("stats:last_scan_processed") or 0
-    scanned_paths = r.smembers("stats:scanned_paths")
+    last_scan_removed = r.get("stats:last_scan_removed") or 0
+    duplicates = r.get("select:duplicates") or 0
+    sync_processed = r.get("stats:sync_processed") or 0
+    sync_removed = r.get("stats:sync_removed") or 0
+    scanned_paths = photos.dir_paths(r, r.smembers("stats:scanned_paths"))
+
+    displays = sorted(r.zrange("displays:active", 0, -1))
+    pipe = r.pipeline(transaction=False)
+    for display in displays:
+        pipe.hgetall(f"display:{display}")
+    display_info = {display: state for display, state in zip(displays, pipe.execute()) if state}
     
     return {
         "total_photos_in_db": int(total_photos),
         "last_scan_found": int(last_scan_found),
         "last_scan_processed": int(last_scan_processed),
-        "scanned_paths": list(scanned_paths)
+        "last_scan_removed": int(last_scan_removed),
+        "near_duplicates_hidden": int(duplicates),
+        "sync_processed": int(sync_processed),
+        "sync_removed": int(sync_removed),
+        "scanned_paths": sorted(path or '/' for path in scanned_paths),
+        "displays": display_info
     }
 
 
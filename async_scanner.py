@@ -0,0 +1,177 @@
+import os
+import time
+import asyncio
+import aiohttp
+import scanner
+import photo_metadata
+import limiter
+from scanner import logger, r
+
+# asyncio scan mode (SCANNER_MODE=async).
+#
+# Directory listings and EXIF range reads all run concurrently on one aiohttp
+# connection pool. An adaptive limiter (limiter.py) sets the number of requests in
+# flight, up to CONCURRENCY, the connector caps connections per host, and a bounded queue of file batches applies
+# backpressure: directory walkers wait while the file workers are behind.
+# Parsing and Redis writes reuse the functions of the threaded scanner.
+
+CONCURRENCY = int(os.getenv('SCANNER_ASYNC_CONCURRENCY', '16'))
+PER_HOST = int(os.getenv('SCANNER_ASYNC_PER_HOST', '8'))
+QUEUE_SIZE = CONCURRENCY * 4
+
+
+class AsyncScan(scanner.Scan):
+    def __init__(self, generation, http):
+        super().__init__(generation, None)
+        self.http = http
+        self.limit = limiter.AsyncLimiter(CONCURRENCY)
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+
+async def request(scan, method, url, **kwargs):
+    # Same as limiter.request() for aiohttp; returns (response, body)
+    for attempt in range(limiter.MAX_RETRIES + 1):
+        resp, body, error = None, None, None
+        await scan.limit.acquire()
+        start = time.monotonic()
+        try:
+            async with scan.http.request(method, url, **kwargs) as resp:
+                body = await resp.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            resp, error = None, e
+        finally:
+            await scan.limit.release()
+
+        if resp is not None and resp.status not in limiter.RETRY_STATUS:
+            kind = limiter.request_class(method, kwargs.get('headers'), len(body))
+            scan.limit.on_success(kind, time.monotonic() - start)
+            return resp, body
+        retry_after = limiter.parse_retry_after(resp.headers.get('Retry-After')) if resp is not None else None
+        scan.limit.on_overload(f"HTTP {resp.status}" if resp is not None else type(error).__name__, retry_after)
+        if attempt < limiter.MAX_RETRIES:
+            await asyncio.sleep(max(retry_after or 0, limiter.backoff(attempt)))
+    if error:
+        raise error
+    return resp, body
+
+
+async def list_directory(scan, path):
+    url = scanner.NC_URL + '/' + path.lstrip('/')
+    resp, content = await request(scan, "PROPFIND", url, data=scanner.PROPFIND_BODY, headers={'Depth': '1'})
+    resp.raise_for_status()
+
+    own = path.rstrip('/')
+    directory = None
+    children = []
+    for entry in scanner.parse_propfind(content):
+        if entry['path'].rstrip('/') == own:
+            directory = entry
+        else:
+            children.append(entry)
+    return directory, children
+
+
+async def read_metadata(scan, entry):
+    url = scanner.NC_URL + '/' + entry['path'].lstrip('/')
+
+    async def fetch(start, end):
+        resp, body = await request(scan, "GET", url, headers={'Range': f'bytes={start}-{end}'})
+        resp.raise_for_status()
+        return start, body, resp.status == 200
+
+    try:
+        return await photo_metadata.read_async(fetch, entry['size'] or None)
+    except Exception as e:
+        logger.error(f"Error reading EXIF for {entry['path']}: {e}")
+    return None
+
+
+async def process_batch(scan, entries):
+    scan.stats.incr("found", len(entries))
+    files = [e for e in entries if e['path'].lower().endswith(scanner.PHOTO_EXTENSIONS)]
+    if not files:
+        return
+    loaded = await asyncio.to_thread(scanner.load_batch, files)
+
+    changed = []
+    pipe = r.pipeline(transaction=False)
+    for entry, (photo_id, cached) in zip(files, loaded):
+        if cached and cached['etag'] and cached['etag'] == entry['etag']:
+            scanner.store_cached(entry['path'], entry, cached, pipe, scan)
+        else:
+            changed.append((entry, photo_id))
+
+    infos = await asyncio.gather(*(read_metadata(scan, entry) for entry, _ in changed))
+    for (entry, photo_id), info in zip(changed, infos):
+        try:
+            scanner.store_photo(entry['path'], photo_id, entry, info, pipe, scan)
+        except Exception as e:
+            logger.error(f"Error processing {entry['path']}: {e}")
+    await asyncio.to_thread(pipe.execute)
+
+    if changed:
+        await asyncio.to_thread(scanner.finish_changed, changed)
+
+
+async def file_worker(scan):
+    while True:
+        path, entries = await scan.queue.get()
+        try:
+            await process_batch(scan, entries)
+        except Exception as e:
+            logger.error(f"Error processing files in {path}: {e}")
+            # Handled like a listing error once the scan is done (scanner.discard_failed)
+            scan.failed.add(path)
+        finally:
+            scan.queue.task_done()
+
+
+async def walk(scan, path, etag=None, known_etag=None):
+    # Same contract as scanner.scan_recursive, with subdirectories walked concurrently
+    try:
+        if await asyncio.to_thread(scanner.unchanged, path, scan, etag, known_etag):
+            return True
+        directory, children = await list_directory(scan, path)
+        visit = await asyncio.to_thread(scanner.visit_directory, path, scan, etag, directory, children)
+        if visit is None:
+            return True
+        if visit.ignored:
+            scan.ignored.add(path)
+
+        for batch in visit.batches:
+            # Blocks while the queue is full
+            await scan.queue.put((path, batch))
+        results = await asyncio.gather(*(
+            walk(scan, entry['path'], entry['etag'], known) for entry, known in visit.subdirs
+        ))
+        ok = all(results)
+
+        if ok and visit.record:
+            scan.dir_records[path] = visit.record
+        return ok
+
+    except Exception as e:
+        logger.error(f"Error scanning {path}: {e}")
+        await asyncio.to_thread(scanner.keep_subtree, path, scan.generation)
+        return False
+
+
+async def scan_tree(photo_path, generation):
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY, limit_per_host=PER_HOST)
+    auth = aiohttp.BasicAuth(scanner.NC_USER or '', scanner.NC_PASS or '')
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(connector=connector, auth=auth, timeout=timeout) as http:
+        scan = AsyncScan(generation, http)
+        workers = [asyncio.create_task(file_worker(scan)) for _ in range(CONCURRENCY)]
+        try:
+            ok = await walk(scan, photo_path)
+            await scan.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    return ok, scan
+
+
+def run(photo_path, generation):
+    return asyncio.run(scan_tree(photo_path, generation))
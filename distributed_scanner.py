@@ -0,0 +1,319 @@
+import json
+import time
+import uuid
+import threading
+import scanner
+import selection
+from scanner import logger, r
+
+# Distributed scan mode (SCANNER_MODE=distributed).
+#
+# The crawl frontier lives in Redis instead of a call stack and an in-memory thread
+# pool queue, so any number of worker replicas can share one scan and a restarted
+# worker picks up where the last one stopped:
+#
+#   scan:run       hash  generation, photo path, sync token, failed, complete
+#   scan:queue     list  pending tasks: one directory to list, or one batch of files
+#   scan:leases    zset  claimed task -> lease deadline; expired leases are requeued
+#   scan:attempts  hash  task -> times claimed; tasks failing MAX_ATTEMPTS times are given up
+#   scan:pending   hash  directory -> children (subdirectories, file batches) not finished yet
+#   scan:parents   hash  directory -> parent directory
+#   scan:dirs      hash  directory -> its record, saved once everything below it is done
+#   scan:bad       set   directories with a failure somewhere below them
+#
+# Finishing a task is one Lua script that checks the lease is still held, queues the
+# children and counts down the pending counters up the tree. A directory's etag is
+# only recorded once its whole subtree is done without errors, like in the other modes.
+# Each worker process runs SCANNER_PARALLEL threads that claim one task at a time, and
+# renews the leases of its running tasks so only tasks of dead workers are handed out again.
+
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+IDLE_SLEEP = 1
+
+RUN_KEY = "scan:run"
+QUEUE_KEY = "scan:queue"
+LEASES_KEY = "scan:leases"
+ATTEMPTS_KEY = "scan:attempts"
+PENDING_KEY = "scan:pending"
+PARENTS_KEY = "scan:parents"
+DIRS_KEY = "scan:dirs"
+BAD_KEY = "scan:bad"
+FINISHING_KEY = "scan:finishing"
+RUN_KEYS = (RUN_KEY, QUEUE_KEY, LEASES_KEY, ATTEMPTS_KEY, PENDING_KEY, PARENTS_KEY, DIRS_KEY, BAD_KEY)
+
+# Join the running scan, or start one with the root directory as the only task.
+# A scheduled start (ARGV[3] = tick key) happens once per tick across all replicas.
+START = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return {0, redis.call('HGET', KEYS[1], 'generation')}
+end
+if ARGV[3] ~= '' and not redis.call('SET', ARGV[3], 1, 'NX', 'EX', 86400) then
+    return {0, ''}
+end
+redis.call('DEL', unpack(KEYS))
+local generation = redis.call('INCR', 'scan:generation')
+redis.call('HSET', KEYS[1], 'generation', generation, 'path', ARGV[1], 'token', ARGV[2])
+redis.call('SET', 'stats:last_scan_found', 0)
+redis.call('SET', 'stats:last_scan_processed', 0)
+redis.call('DEL', 'stats:scanned_paths')
+redis.call('RPUSH', KEYS[2], ARGV[4])
+return {1, generation}
+""")
+
+# Requeue tasks whose lease expired (their worker died), then claim the next task.
+# Lease deadlines are in milliseconds of the Redis server clock.
+CLAIM = r.register_script("""
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+for _, task in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('ZREM', KEYS[2], task)
+    redis.call('RPUSH', KEYS[1], task)
+end
+local task = redis.call('LPOP', KEYS[1])
+if not task then return false end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]) * 1000, task)
+return {task, redis.call('HINCRBY', KEYS[3], task, 1)}
+""")
+
+# Extend the leases still held (XX: not those already requeued)
+RENEW = r.register_script("""
+local time = redis.call('TIME')
+local deadline = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000) + tonumber(ARGV[1]) * 1000
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], 'XX', deadline, ARGV[i])
+end
+""")
+
+# ARGV: task, directory (dir tasks) or '', parent directory, failed, directory record
+# or '', number of children, then (child task, child directory or '') pairs.
+# Returns the directories whose subtree finished without errors, false if the lease was lost.
+COMPLETE = r.register_script("""
+local leases, queue, pending, parents, dirs, bad, run, attempts = unpack(KEYS)
+local task, node, up, failed, record = ARGV[1], ARGV[2], ARGV[3], ARGV[4] == '1', ARGV[5]
+if redis.call('ZREM', leases, task) == 0 then return false end
+redis.call('HDEL', attempts, task)
+
+local count = tonumber(ARGV[6])
+for i = 0, count - 1 do
+    local child, path = ARGV[7 + 2 * i], ARGV[8 + 2 * i]
+    redis.call('RPUSH', queue, child)
+    if path ~= '' then redis.call('HSET', parents, path, node) end
+end
+if failed then
+    redis.call('HSET', run, 'failed', 1)
+    redis.call('SADD', bad, node ~= '' and node or up)
+end
+if node ~= '' and record ~= '' then redis.call('HSET', dirs, node, record) end
+if node ~= '' and count > 0 then
+    redis.call('HSET', pending, node, count)
+    return {}
+end
+
+-- Count down the parents; every directory reaching zero is finished
+local finished = {}
+local current = node
+while true do
+    if current ~= '' then
+        if redis.call('SISMEMBER', bad, current) == 1 then
+            if up ~= '' then redis.call('SADD', bad, up) end
+        else
+            table.insert(finished, current)
+        end
+    end
+    if up == '' then
+        redis.call('HSET', run, 'complete', 1)
+        break
+    end
+    if redis.call('HINCRBY', pending, up, -1) > 0 then break end
+    redis.call('HDEL', pending, up)
+    current = up
+    up = redis.call('HGET', parents, up) or ''
+end
+return finished
+""")
+
+
+def new_task(kind, path, **fields):
+    # The id keeps two otherwise identical tasks apart in the queue and the lease set
+    return json.dumps(dict(fields, id=uuid.uuid4().hex[:12], type=kind, path=path))
+
+
+def list_dir(task, scan):
+    # One directory of the walk (see scanner.visit_directory).
+    # Returns (child tasks as (task, directory or ''), record to save or None).
+    path, etag = task['path'], task.get('etag')
+    if scanner.unchanged(path, scan, etag, task.get('known')):
+        return [], None
+    visit = scanner.visit_directory(path, scan, etag, *scanner.list_directory(path))
+    if visit is None:
+        return [], None
+
+    tasks = [(new_task("dir", entry['path'], etag=entry['etag'], known=known), entry['path'])
+             for entry, known in visit.subdirs]
+    tasks += [(new_task("files", path, entries=batch), '') for batch in visit.batches]
+    record = [*visit.record, visit.ignored] if visit.record else None
+    return tasks, record
+
+
+class DistributedScan(scanner.Scan):
+    def __init__(self, generation):
+        super().__init__(generation, None)
+        self.lock = threading.Lock()
+        self.running = set()  # Tasks claimed by this process
+        self.done = threading.Event()
+
+
+def heartbeat(scan):
+    while not scan.done.wait(LEASE_SECONDS / 3):
+        with scan.lock:
+            running = list(scan.running)
+        if running:
+            try:
+                RENEW(keys=[LEASES_KEY], args=[LEASE_SECONDS] + running)
+            except Exception as e:
+                logger.error(f"Error renewing scan leases: {e}")
+
+
+def run_task(raw, attempts, scan):
+    with scan.lock:
+        scan.running.add(raw)
+    try:
+        complete_task(raw, attempts, scan)
+    finally:
+        with scan.lock:
+            scan.running.discard(raw)
+
+
+def complete_task(raw, attempts, scan):
+    task = json.loads(raw)
+    path = task['path']
+    is_dir = task['type'] == 'dir'
+    children, record, failed = [], None, False
+    try:
+        if attempts > MAX_ATTEMPTS:
+            raise RuntimeError(f"giving up after {attempts - 1} attempts")
+        if is_dir:
+            children, record = list_dir(task, scan)
+        else:
+            scanner.process_batch(task['entries'], scan)
+    except Exception as e:
+        logger.error(f"Error scanning {path}: {e}")
+        failed = True
+        if is_dir:
+            scanner.keep_subtree(path, scan.generation)
+
+    node = path if is_dir else ''
+    parent = (r.hget(PARENTS_KEY, path) or '') if is_dir else path
+    args = [raw, node, parent, '1' if failed else '0', json.dumps(record) if record else '', len(children)]
+    for child, child_dir in children:
+        args += [child, child_dir]
+    finished = COMPLETE(keys=[LEASES_KEY, QUEUE_KEY, PENDING_KEY, PARENTS_KEY, DIRS_KEY, BAD_KEY, RUN_KEY, ATTEMPTS_KEY],
+                        args=args)
+    if finished is False or finished is None:
+        logger.warning(f"Lease on {path} expired, its work is done again by another worker")
+    elif finished:
+        save_finished(finished, scan.generation)
+
+
+def save_finished(paths, generation):
+    # Directory etags and file lists of completed subtrees (see scanner.save_dir_records)
+    records = {}
+    ignored = set()
+    for path, raw in zip(paths, r.hmget(DIRS_KEY, paths)):
+        if raw:
+            etag, files, subdirs, is_ignored = json.loads(raw)
+            records[path] = (etag, files, subdirs)
+            if is_ignored:
+                ignored.add(path)
+    if records:
+        scanner.save_dir_records(records, generation, ignored)
+        r.hdel(DIRS_KEY, *records)
+
+
+def frontier():
+    # (queued tasks, leased tasks, run state) read atomically
+    pipe = r.pipeline(transaction=True)
+    pipe.llen(QUEUE_KEY)
+    pipe.zcard(LEASES_KEY)
+    pipe.hgetall(RUN_KEY)
+    return pipe.execute()
+
+
+def work(scan):
+    # One claiming thread; returns when no task is queued or leased any more
+    while True:
+        claimed = CLAIM(keys=[QUEUE_KEY, LEASES_KEY, ATTEMPTS_KEY], args=[LEASE_SECONDS])
+        if claimed:
+            run_task(claimed[0], int(claimed[1]), scan)
+            continue
+        queued, leased, _ = frontier()
+        if not queued and not leased:
+            return
+        # Other workers still hold tasks that may add more
+        time.sleep(IDLE_SLEEP)
+
+
+def finish(scan):
+    queued, leased, state = frontier()
+    if queued or leased or not state:
+        # Still being worked on, or already finished by another worker
+        return
+    if not state.get('complete'):
+        # Queue and leases are empty but the root never finished: tasks were lost
+        # (e.g. Redis restarted without persistence). Start over next time.
+        logger.warning("Scan frontier is empty but the scan did not complete, abandoning it")
+        r.delete(*RUN_KEYS)
+        return
+    if not r.set(FINISHING_KEY, scan.generation, nx=True, ex=LEASE_SECONDS):
+        return
+    scan.stats.flush()
+    favorites = scanner.refresh_favorites(state['path'])
+    if favorites:
+        logger.info(f"Updated the favorite flag of {favorites} photos")
+    if not state.get('failed'):
+        removed = scanner.sweep(scan.generation)
+        r.set("stats:last_scan_removed", removed)
+        logger.info(f"Removed {removed} stale photos")
+        if state.get('token'):
+            r.set("sync:token", state['token'])
+    else:
+        logger.warning("Scan had errors, skipping removal of stale photos")
+
+    count, total = selection.rebuild_index(r)
+    duplicates = r.get("select:duplicates") or 0
+    logger.info(f"Selection index rebuilt: {count} photos, {duplicates} near-duplicates collapsed, total weight {total:.0f}")
+    r.delete(*RUN_KEYS)
+    r.delete(FINISHING_KEY)
+
+
+def run(photo_path, tick=None):
+    # Start a scan or join the one in progress; returns once the frontier is drained.
+    # tick (the scheduled start time) keeps replicas from starting the same scan twice.
+    token = ''
+    if scanner.SYNC_INTERVAL:
+        import sync_collection
+        try:
+            token = sync_collection.current_token(photo_path) or ''
+        except Exception as e:
+            logger.warning(f"Could not read sync token, sync mode unavailable: {e}")
+
+    started, generation = START(keys=list(RUN_KEYS), args=[
+        photo_path, token, f"scan:tick:{tick}" if tick else '', new_task("dir", photo_path)])
+    if not generation:
+        logger.info("Scheduled scan already done by another worker")
+        return
+    generation = int(generation)
+    logger.info(f"{'Started' if started else 'Joined'} distributed scan of {photo_path} "
+                f"with {scanner.MAX_WORKERS} threads (generation {generation})...")
+
+    scan = DistributedScan(generation)
+    threading.Thread(target=heartbeat, args=(scan,), daemon=True).start()
+    threads = [threading.Thread(target=work, args=(scan,)) for _ in range(scanner.MAX_WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scan.done.set()
+    scan.stats.flush()
+    finish(scan)
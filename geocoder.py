@@ -0,0 +1,210 @@
+import os
+import io
+import sys
+import math
+import mmap
+import time
+import struct
+import zipfile
+import tempfile
+import urllib.request
+
+# Offline reverse geocoder.
+#
+# Place names come from the GeoNames cities dataset (CC BY 4.0). The worker downloads
+# it once at runtime (GEOCODER_SOURCE, a URL or a local file for offline installs)
+# and converts it into a compact binary file on the shared data volume, which is
+# memory-mapped on first use:
+#
+#   header   magic "GEO1", place count, size of the name table
+#   cells    (180 * 360 + 1) uint32: index of the first place in each 1x1 degree cell
+#   places   count * (lat, lon as int32 in 1e-5 degrees, uint32 offset into names)
+#   names    length-prefixed UTF-8 "name\x1fcountry code" strings
+#
+# A lookup scans the photo's cell and its neighbours, so it touches a few hundred
+# bytes of the file and needs no external service. Until the file exists, lookups
+# return None and captions fall back to the folder name.
+
+DATA_FILE = os.getenv('GEOCODER_DATA', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'places.bin'))
+MAX_DISTANCE_KM = float(os.getenv('GEOCODER_MAX_KM', '50'))
+SOURCE_URL = os.getenv('GEOCODER_SOURCE', 'https://download.geonames.org/export/dump/cities15000.zip')
+# A missing index is looked for again after this many seconds (the worker may be building it)
+RETRY_SECONDS = 300
+
+MAGIC = b'GEO1'
+HEADER = struct.Struct('<4sII')
+PLACE = struct.Struct('<iiI')
+CELLS = 180 * 360
+KM_PER_DEGREE = 111.195
+
+_index = None
+_missing_since = None
+
+
+def cell_of(lat, lon):
+    row = min(179, max(0, int(math.floor(lat)) + 90))
+    col = int(math.floor(lon)) % 360
+    return row * 360 + col
+
+
+class PlaceIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, _ = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a place index")
+        self.places = HEADER.size + (CELLS + 1) * 4
+        self.names = self.places + self.count * PLACE.size
+
+    def _cell_range(self, cell):
+        return struct.unpack_from('<II', self.data, HEADER.size + cell * 4)
+
+    def _name(self, offset):
+        length = self.data[self.names + offset]
+        raw = self.data[self.names + offset + 1:self.names + offset + 1 + length]
+        name, _, country = raw.decode('utf-8').partition('\x1f')
+        return name, country
+
+    def nearest(self, lat, lon, max_km=MAX_DISTANCE_KM):
+        # Returns (name, country code, distance in km) or None
+        scale = math.cos(math.radians(lat))
+        # One cell is 1 degree of longitude, which gets narrower towards the poles
+        lon_ring = min(180, math.ceil(1 / max(scale, 0.01)))
+        row = min(179, max(0, int(math.floor(lat)) + 90))
+        col = int(math.floor(lon))
+
+        best, best_offset = None, None
+        for r in range(max(0, row - 1), min(179, row + 1) + 1):
+            for c in range(col - lon_ring, col + lon_ring + 1):
+                start, end = self._cell_range(r * 360 + c % 360)
+                for i in range(start, end):
+                    plat, plon, offset = PLACE.unpack_from(self.data, self.places + i * PLACE.size)
+                    dlat = plat / 1e5 - lat
+                    dlon = (plon / 1e5 - lon + 180) % 360 - 180
+                    dist = dlat * dlat + (dlon * scale) ** 2
+                    if best is None or dist < best:
+                        best, best_offset = dist, offset
+
+        if best is None:
+            return None
+        km = math.sqrt(best) * KM_PER_DEGREE
+        if km > max_km:
+            return None
+        name, country = self._name(best_offset)
+        return name, country, km
+
+
+def get_index():
+    global _index, _missing_since
+    if _index is None:
+        if _missing_since and time.monotonic() - _missing_since < RETRY_SECONDS:
+            return None
+        try:
+            _index = PlaceIndex(DATA_FILE)
+            _missing_since = None
+        except (OSError, ValueError) as e:
+            if not _missing_since:
+                print(f"Reverse geocoding unavailable: {e}", file=sys.stderr)
+            _missing_since = time.monotonic()
+    return _index
+
+
+def lookup(lat, lon):
+    # (place name, country code) for coordinates, or None if unknown or no index is installed
+    index = get_index()
+    if not index:
+        return None
+    found = index.nearest(lat, lon)
+    return found[:2] if found else None
+
+
+def parse_gps(value):
+    # Parses the "lat,lon" gps field of photo records written by older versions
+    try:
+        lat, lon = value.split(',')
+        return float(lat), float(lon)
+    except (AttributeError, ValueError):
+        return None
+
+
+def build(rows, target):
+    # rows: iterable of (name, country code, lat, lon)
+    cells = [[] for _ in range(CELLS)]
+    for name, country, lat, lon in rows:
+        cells[cell_of(lat, lon)].append((name, country, lat, lon))
+
+    names = bytearray()
+    places = bytearray()
+    starts = []
+    count = 0
+    for cell in cells:
+        starts.append(count)
+        for name, country, lat, lon in cell:
+            raw = f"{name}\x1f{country}".encode('utf-8')[:255]
+            places += PLACE.pack(round(lat * 1e5), round(lon * 1e5), len(names))
+            names += bytes([len(raw)]) + raw
+            count += 1
+    starts.append(count)
+
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    # Unique temporary name: worker replicas sharing the data volume may build at the same time
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, count, len(names)))
+        f.write(struct.pack(f'<{len(starts)}I', *starts))
+        f.write(places)
+        f.write(names)
+    os.replace(tmp, target)
+    return count
+
+
+def read_geonames(lines):
+    # GeoNames dump format: tab separated, name in column 1, lat/lon in 4/5, country code in 8
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 9:
+            continue
+        try:
+            yield fields[1], fields[8], float(fields[4]), float(fields[5])
+        except ValueError:
+            continue
+
+
+def build_from_geonames(source=SOURCE_URL, target=DATA_FILE):
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source, timeout=120) as resp:
+            raw = resp.read()
+    else:
+        with open(source, 'rb') as f:
+            raw = f.read()
+
+    if raw[:2] == b'PK':
+        with zipfile.ZipFile(io.BytesIO(raw)) as archive:
+            member = next(n for n in archive.namelist() if n.endswith('.txt'))
+            raw = archive.read(member)
+    lines = io.StringIO(raw.decode('utf-8'))
+    return build(read_geonames(lines), target)
+
+
+def ensure_index(retry_seconds=3600):
+    # Worker thread: build the place index once if the data volume has none yet.
+    # Download errors are retried hourly; lookups meanwhile return None.
+    global _index, _missing_since
+    while not os.path.exists(DATA_FILE):
+        try:
+            count = build_from_geonames()
+            print(f"Wrote {count} places to {DATA_FILE}", file=sys.stderr)
+            _index, _missing_since = None, None
+            return
+        except Exception as e:
+            print(f"Could not build the place index from {SOURCE_URL}: {e}", file=sys.stderr)
+            time.sleep(retry_seconds)
+
+
+if __name__ == "__main__":
+    # python geocoder.py [source file or URL] [target]
+    source = sys.argv[1] if len(sys.argv) > 1 else SOURCE_URL
+    target = sys.argv[2] if len(sys.argv) > 2 else DATA_FILE
+    count = build_from_geonames(source, target)
+    print(f"Wrote {count} places to {target}")
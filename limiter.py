@@ -0,0 +1,190 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+
+# Adaptive concurrency for the scanner's requests to Nextcloud.
+#
+# The number of requests in flight is controlled with AIMD, like TCP congestion
+# control: every successful request raises the limit by 1/limit (about +1 per round
+# of requests), and signs of overload halve it, at most once per DECREASE_INTERVAL so
+# one burst of errors counts once. Overload is a 429/502/503/504 response, a timeout
+# or connection error, or a smoothed latency several times the baseline (the fastest
+# seen recently for that class of request, see request_class). Retry-After pauses all
+# requests, and failed requests are retried with jittered exponential backoff.
+
+logger = logging.getLogger(__name__)
+
+MIN_LIMIT = 1
+INITIAL_LIMIT = 4
+DECREASE_INTERVAL = 2.0
+# Smoothed latency above baseline * LATENCY_FACTOR counts as congestion
+LATENCY_FACTOR = 3
+LATENCY_SMOOTHING = 0.2
+# How fast the baseline follows latencies above it, so it adapts to a slower server
+BASELINE_DRIFT = 0.01
+
+TIMEOUT = 60
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+RETRY_AFTER_MAX = 300
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+def parse_retry_after(value, now=None):
+    # Retry-After is either seconds or an HTTP date; returns seconds or None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - (now or time.time())
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), RETRY_AFTER_MAX)
+
+
+def request_class(method, headers=None, size=0):
+    # Latency baselines are kept per class: listings (PROPFIND with its Depth), range
+    # reads and other requests, each also by response size in factors of 2 (KB). A
+    # large folder listing takes longer than a small one without any overload, so
+    # both must not share a baseline.
+    headers = headers or {}
+    kind = method
+    if 'Depth' in headers:
+        kind += f" depth={headers['Depth']}"
+    if 'Range' in headers:
+        kind += " range"
+    return f"{kind} {(size // 1024).bit_length()}"
+
+
+def backoff(attempt):
+    # Exponential backoff with jitter: half fixed, half random, so retries spread out
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class AIMD:
+    def __init__(self, maximum, initial=INITIAL_LIMIT):
+        self.maximum = max(MIN_LIMIT, maximum)
+        self.limit = float(max(MIN_LIMIT, min(initial, self.maximum)))
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.latency = {}  # kind -> [baseline, smoothed] in seconds
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def on_success(self, kind, elapsed):
+        with self.lock:
+            baseline, smoothed = self.latency.get(kind, (elapsed, elapsed))
+            baseline = min(elapsed, baseline + (elapsed - baseline) * BASELINE_DRIFT)
+            smoothed += (elapsed - smoothed) * LATENCY_SMOOTHING
+            self.latency[kind] = [baseline, smoothed]
+            if smoothed > baseline * LATENCY_FACTOR:
+                self._decrease(f"{kind} latency {smoothed:.2f}s")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self, reason, retry_after=None):
+        with self.lock:
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self._decrease(reason)
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+        before = self.limit
+        self.limit = max(MIN_LIMIT, self.limit / 2)
+        logger.warning(f"Nextcloud overloaded ({reason}), concurrent requests {before:.0f} -> {self.limit:.0f}")
+
+    def _wait_time(self):
+        # Seconds until a request may start: 0 = now, None = when one finishes
+        paused = self.paused_until - time.monotonic()
+        if paused > 0:
+            return paused
+        return 0 if self.inflight < int(self.limit) else None
+
+
+class Limiter(AIMD):
+    # For threads; also a context manager that only takes a slot
+    def __init__(self, maximum, initial=INITIAL_LIMIT):
+        super().__init__(maximum, initial)
+        self.changed = threading.Condition(self.lock)
+
+    def acquire(self):
+        with self.changed:
+            wait = self._wait_time()
+            while wait != 0:
+                self.changed.wait(wait)
+                wait = self._wait_time()
+            self.inflight += 1
+
+    def release(self):
+        with self.changed:
+            self.inflight -= 1
+            self.changed.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AsyncLimiter(AIMD):
+    # For one asyncio event loop
+    def __init__(self, maximum, initial=INITIAL_LIMIT):
+        super().__init__(maximum, initial)
+        self.changed = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.changed:
+            wait = self._wait_time()
+            while wait != 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                wait = self._wait_time()
+            self.inflight += 1
+
+    async def release(self):
+        async with self.changed:
+            self.inflight -= 1
+            self.changed.notify_all()
+
+
+def request(limiter, session, method, url, **kwargs):
+    # session.request() under the limiter. Overload responses, timeouts and connection
+    # errors are retried; any other response (also 404 etc.) is returned as it is.
+    kwargs.setdefault('timeout', TIMEOUT)
+    for attempt in range(MAX_RETRIES + 1):
+        resp, error = None, None
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            resp = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            limiter.release()
+
+        if resp is not None and resp.status_code not in RETRY_STATUS:
+            kind = request_class(method, kwargs.get('headers'), len(resp.content))
+            limiter.on_success(kind, time.monotonic() - start)
+            return resp
+        retry_after = parse_retry_after(resp.headers.get('Retry-After')) if resp is not None else None
+        limiter.on_overload(f"HTTP {resp.status_code}" if resp is not None else type(error).__name__, retry_after)
+        if attempt < MAX_RETRIES:
+            time.sleep(max(retry_after or 0, backoff(attempt)))
+    if error:
+        raise error
+    return resp
@@ -0,0 +1,390 @@
+import io
+import os
+import struct
+from PIL import Image
+
+# Incremental metadata reader for JPEG, PNG and WebP.
+#
+# Instead of downloading a fixed 256 KB prefix, the container structure is walked
+# segment by segment: JPEG markers, PNG chunks, RIFF/WebP chunks. Large segments
+# that carry no metadata (ICC profiles, image data) are skipped without being
+# downloaded, more bytes are requested only when the next segment lies beyond what
+# has been fetched, and reading stops as soon as the capture date, orientation,
+# dimensions and GPS position are known.
+#
+# The parsers are generators that yield (offset, length) and receive the bytes,
+# so the same code serves the blocking scanner (read) and the asyncio one (read_async).
+
+INITIAL_FETCH = int(os.getenv('EXIF_INITIAL_FETCH_KB', '64')) * 1024
+MAX_FETCH = 1024 * 1024
+# Give up after this many bytes or requests; whatever was found so far is kept
+MAX_BYTES = 2 * 1024 * 1024
+MAX_REQUESTS = 8
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+IFD1 = -1
+TAG_MODEL = 0x0110
+TAG_ORIENTATION = 0x0112
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+TAG_DATETIME = 0x0132
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_EXIF_WIDTH = 0xA002
+TAG_EXIF_HEIGHT = 0xA003
+
+# JPEG start-of-frame markers carrying the image dimensions
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+# EXIF orientation -> transpose that brings the image upright
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class Budget(Exception):
+    pass
+
+
+class Metadata:
+    def __init__(self):
+        self.timestamp = "Unknown"
+        self.orientation = None
+        self.width = None
+        self.height = None
+        self.gps = None
+        self.camera = None
+        self.thumbnail = None  # Embedded JPEG thumbnail (EXIF IFD1), if any
+        self.exif = None  # Raw TIFF/EXIF block, if any
+        self.exif_size = None  # PixelXDimension/PixelYDimension, fallback for width/height
+
+    def complete(self):
+        return self.exif is not None and self.width is not None
+
+
+class RangeReader:
+    # Caches fetched spans; each miss fetches at least the next block size, which
+    # doubles on every request so a file needing more data converges quickly.
+    def __init__(self, size=None):
+        self.size = size
+        self.spans = []
+        self.next_fetch = INITIAL_FETCH
+        self.fetched = 0
+        self.requests = 0
+
+    def lookup(self, offset, length):
+        for start, data in self.spans:
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset + length - start]
+            if start <= offset < start + len(data) and start + len(data) == self.size:
+                # Truncated at end of file
+                return data[offset - start:]
+        if self.size is not None and offset >= self.size:
+            return b''
+        return None
+
+    def plan(self, offset, length):
+        if self.requests >= MAX_REQUESTS or self.fetched >= MAX_BYTES:
+            raise Budget()
+        end = offset + max(length, self.next_fetch) - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        self.next_fetch = min(self.next_fetch * 2, MAX_FETCH)
+        self.requests += 1
+        return offset, end
+
+    def store(self, start, data, requested_end, whole_file=False):
+        self.fetched += len(data)
+        if whole_file:
+            # Server ignored the Range header and sent everything
+            self.size = len(data)
+        elif len(data) < requested_end - start + 1:
+            # Short read: end of file
+            self.size = start + len(data)
+        self.spans.append((start, data))
+
+
+def read(fetch, size=None):
+    # fetch(start, end) -> (start, bytes, whole_file)
+    reader = RangeReader(size)
+    parser = _parse(size)
+    try:
+        request = next(parser)
+        while True:
+            data = reader.lookup(*request)
+            if data is None:
+                start, end = reader.plan(*request)
+                got_start, got, whole = fetch(start, end)
+                reader.store(got_start, got, end, whole)
+                data = reader.lookup(*request) or b''
+            request = parser.send(data)
+    except StopIteration as stop:
+        return stop.value
+    except Budget:
+        return _partial(parser)
+
+
+async def read_async(fetch, size=None):
+    # Same as read() with an awaitable fetch
+    reader = RangeReader(size)
+    parser = _parse(size)
+    try:
+        request = next(parser)
+        while True:
+            data = reader.lookup(*request)
+            if data is None:
+                start, end = reader.plan(*request)
+                got_start, got, whole = await fetch(start, end)
+                reader.store(got_start, got, end, whole)
+                data = reader.lookup(*request) or b''
+            request = parser.send(data)
+    except StopIteration as stop:
+        return stop.value
+    except Budget:
+        return _partial(parser)
+
+
+def _partial(parser):
+    # Ask the parser to finish with what it has
+    try:
+        parser.throw(Budget())
+    except StopIteration as stop:
+        return stop.value
+    except Budget:
+        pass
+    return Metadata()
+
+
+def _parse(size=None):
+    meta = Metadata()
+    try:
+        head = yield (0, 16)
+        if head[:2] == b'\xff\xd8':
+            yield from _parse_jpeg(meta)
+        elif head[:8] == b'\x89PNG\r\n\x1a\n':
+            yield from _parse_png(meta, size)
+        elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            yield from _parse_webp(meta)
+    except Budget:
+        pass
+    if meta.width is None and meta.exif_size:
+        meta.width, meta.height = meta.exif_size
+    return meta
+
+
+def _parse_jpeg(meta):
+    pos = 2
+    while True:
+        header = yield (pos, 4)
+        if len(header) < 2 or header[0] != 0xFF:
+            return
+        marker = header[1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA) or len(header) < 4:
+            # End of image / start of scan: no more metadata before the image data
+            return
+        length = struct.unpack('>H', header[2:4])[0]
+
+        if marker == 0xE1 and meta.exif is None:
+            segment = yield (pos + 4, length - 2)
+            if segment[:6] == b'Exif\x00\x00':
+                _load_exif(meta, segment[6:])
+        elif marker in SOF_MARKERS:
+            sof = yield (pos + 4, 5)
+            if len(sof) == 5:
+                meta.height, meta.width = struct.unpack('>HH', sof[1:5])
+
+        if meta.complete():
+            return
+        pos += 2 + length
+
+
+def _find_png_exif(tail):
+    # eXIf chunk in the last bytes of a PNG; its length field must fit and its data
+    # must start with a TIFF header, so compressed image data is not mistaken for one
+    pos = tail.rfind(b'eXIf')
+    while pos >= 4:
+        length = struct.unpack('>I', tail[pos - 4:pos])[0]
+        data = tail[pos + 4:pos + 4 + length]
+        if len(data) == length and data[:4] in (b'II*\x00', b'MM\x00*'):
+            return data
+        pos = tail.rfind(b'eXIf', 0, pos)
+    return None
+
+
+def _parse_png(meta, size=None):
+    pos = 8
+    while True:
+        header = yield (pos, 8)
+        if len(header) < 8:
+            return
+        length, ctype = struct.unpack('>I4s', header)
+        if ctype == b'IHDR':
+            data = yield (pos + 8, 8)
+            if len(data) == 8:
+                meta.width, meta.height = struct.unpack('>II', data)
+        elif ctype == b'eXIf':
+            data = yield (pos + 8, length)
+            _load_exif(meta, data)
+        elif ctype == b'IDAT':
+            # Walking the image data chunks would download most of the file. eXIf
+            # usually comes before them; when it does not, it is near the end, so
+            # one read of the file's tail finds it.
+            if meta.exif is None and size and size > pos + INITIAL_FETCH:
+                tail = yield (size - INITIAL_FETCH, INITIAL_FETCH)
+                data = _find_png_exif(tail)
+                if data:
+                    _load_exif(meta, data)
+            elif meta.exif is None and size:
+                # The rest of the file is small: keep walking the chunks
+                pos += 12 + length
+                continue
+            return
+        elif ctype == b'IEND':
+            return
+
+        if meta.complete():
+            return
+        pos += 12 + length
+
+
+def _parse_webp(meta):
+    pos = 12
+    while True:
+        header = yield (pos, 8)
+        if len(header) < 8:
+            return
+        fourcc, length = struct.unpack('<4sI', header)
+        if fourcc == b'VP8X':
+            data = yield (pos + 8, 10)
+            if len(data) == 10:
+                meta.width = 1 + int.from_bytes(data[4:7], 'little')
+                meta.height = 1 + int.from_bytes(data[7:10], 'little')
+        elif fourcc == b'VP8 ' and meta.width is None:
+            data = yield (pos + 8, 10)
+            if len(data) == 10 and data[3:6] == b'\x9d\x01\x2a':
+                meta.width = struct.unpack('<H', data[6:8])[0] & 0x3FFF
+                meta.height = struct.unpack('<H', data[8:10])[0] & 0x3FFF
+        elif fourcc == b'VP8L' and meta.width is None:
+            data = yield (pos + 8, 5)
+            if len(data) == 5 and data[0] == 0x2F:
+                bits = int.from_bytes(data[1:5], 'little')
+                meta.width = 1 + (bits & 0x3FFF)
+                meta.height = 1 + ((bits >> 14) & 0x3FFF)
+        elif fourcc == b'EXIF':
+            data = yield (pos + 8, length)
+            if data[:6] == b'Exif\x00\x00':
+                data = data[6:]
+            _load_exif(meta, data)
+
+        if meta.complete():
+            return
+        # Chunks are padded to an even size
+        pos += 8 + length + (length & 1)
+
+
+def _rational(value):
+    try:
+        return float(value)
+    except (TypeError, ZeroDivisionError, ValueError):
+        num, den = value
+        return num / den if den else 0.0
+
+
+def _gps_coordinate(value, ref):
+    degrees, minutes, seconds = (_rational(v) for v in value)
+    decimal = degrees + minutes / 60 + seconds / 3600
+    if ref in ('S', 'W', b'S', b'W'):
+        decimal = -decimal
+    return decimal
+
+
+def _load_exif(meta, tiff):
+    meta.exif = tiff
+    try:
+        exif = Image.Exif()
+        exif.load(tiff)
+    except Exception:
+        return
+
+    meta.orientation = exif.get(TAG_ORIENTATION)
+    model = exif.get(TAG_MODEL)
+    if isinstance(model, str) and model.strip('\x00 '):
+        meta.camera = model.strip('\x00 ')
+    sub = exif.get_ifd(EXIF_IFD)
+    date_taken = sub.get(TAG_DATETIME_ORIGINAL) or exif.get(TAG_DATETIME)
+    if isinstance(date_taken, str) and date_taken.strip('\x00 '):
+        meta.timestamp = date_taken.strip('\x00 ')
+    if sub.get(TAG_EXIF_WIDTH) and sub.get(TAG_EXIF_HEIGHT):
+        meta.exif_size = (int(sub[TAG_EXIF_WIDTH]), int(sub[TAG_EXIF_HEIGHT]))
+
+    gps = exif.get_ifd(GPS_IFD)
+    try:
+        if 2 in gps and 4 in gps:
+            meta.gps = (_gps_coordinate(gps[2], gps.get(1)), _gps_coordinate(gps[4], gps.get(3)))
+    except Exception:
+        meta.gps = None
+
+    try:
+        ifd1 = exif.get_ifd(IFD1)
+        offset, length = ifd1.get(TAG_THUMBNAIL_OFFSET), ifd1.get(TAG_THUMBNAIL_LENGTH)
+        # Offsets are relative to the TIFF header, which is where tiff starts
+        if offset and length and offset + length <= len(tiff):
+            meta.thumbnail = tiff[offset:offset + length]
+    except Exception:
+        meta.thumbnail = None
+
+
+def display_size(width, height, orientation):
+    # Width and height as shown, after applying the EXIF orientation
+    if orientation in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+
+def perceptual_hash(image, orientation=None):
+    # 64-bit difference hash (dHash) as 16 hex digits: compares neighbouring pixels
+    # of a 9x8 grayscale version, so it survives resizing and recompression.
+    # Without an orientation, the image's own EXIF orientation is applied.
+    if orientation is None:
+        orientation = image.getexif().get(TAG_ORIENTATION)
+    image.draft('L', (64, 64))
+    if orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    small = image.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def image_hash(source, orientation=None):
+    # Perceptual hash of an image file or file object, None if it cannot be decoded
+    try:
+        with Image.open(source) as image:
+            return perceptual_hash(image, orientation)
+    except Exception:
+        return None
+
+
+def thumbnail_hash(meta):
+    # Perceptual hash from the embedded EXIF thumbnail, without touching the full image
+    if not meta.thumbnail:
+        return None
+    return image_hash(io.BytesIO(meta.thumbnail), meta.orientation)
@@ -0,0 +1,391 @@
+import os
+import re
+import sys
+import time
+import struct
+import posixpath
+from redis.client import NEVER_DECODE
+
+# Compact photo records.
+#
+# Photos are identified by integer ids. photo_pool, the selection index, display
+# histories, prefetch queues and directory file lists all store the id instead of
+# the full WebDAV path. Directories are interned the same way, so a path is stored
+# once, as a directory id plus the file name.
+#
+#   photo:dirs            hash  directory path -> directory id
+#   photo:dir_paths       hash  directory id -> directory path
+#   photo:names:<dir id>  hash  file name -> photo id
+#   photo:rec:<bucket>    hash  photo id % BUCKET_SIZE -> packed record (bucket = id // BUCKET_SIZE)
+#
+# A record is a fixed-width header followed by length-prefixed UTF-8 strings (file
+# name, etag, camera, place, country). Buckets of a few hundred small values stay in
+# Redis' listpack encoding (hash-max-listpack-entries/-value, see docker-compose.yml),
+# so a photo costs its record plus a few bytes instead of a key, a hash table and
+# field names of its own.
+
+BUCKET_SIZE = 512
+BATCH_SIZE = 500
+
+NEXT_ID_KEY = "photo:next_id"
+DIRS_KEY = "photo:dirs"
+DIR_PATHS_KEY = "photo:dir_paths"
+NEXT_DIR_KEY = "photo:next_dir"
+RECORD_PREFIX = "photo:rec:"
+# Set once photo:<path> hashes from older versions have been migrated
+SCHEMA_KEY = "photo:schema"
+SCHEMA_VERSION = "2"
+# Held by the worker replica that migrates; renewed after every batch
+MIGRATE_LOCK = "photo:migrating"
+MIGRATE_LOCK_SECONDS = 300
+
+# dir id, generation, capture epoch (0 = unknown), flags, orientation, width, height,
+# size, lat, lon (1e-5 degrees), file id, perceptual hash, cluster (photo id, 0 = none)
+HEADER = struct.Struct('>IIqBBIIQiiQQI')
+STRINGS = ('name', 'etag', 'camera', 'place', 'country')
+FAVORITE = 1
+HAS_GPS = 2
+
+# Directory ids are never reused, so both directions can be cached for the life of the process
+_dir_ids = {}
+_dir_paths = {}
+
+# Get-or-create a directory id (the scanner's threads may meet a new directory at the same time)
+INTERN_DIR = """
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if id then return id end
+id = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[1], ARGV[1], id)
+redis.call('HSET', KEYS[2], id, ARGV[1])
+return id
+"""
+
+# Compare-and-set of one packed record, so an update never writes back a stale copy
+# (e.g. an older generation, which would make the next sweep delete a live photo)
+SWAP_RECORD = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then return 0 end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return 1
+"""
+UPDATE_RETRIES = 10
+
+# Forget a file name only while it still maps to the photo being removed: if the path
+# got another id in the meantime, that photo's mapping must survive the sweep
+REMOVE_NAME = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+"""
+
+
+def split(path):
+    # "/Photos/2020/a.jpg" -> ("/Photos/2020", "a.jpg"); the root directory is ""
+    directory, name = posixpath.split(path)
+    return directory.rstrip('/'), name
+
+
+def join(directory, name):
+    return f"{directory}/{name}"
+
+
+def normalize_dir(path):
+    return path.rstrip('/')
+
+
+def record_field(photo_id):
+    photo_id = int(photo_id)
+    return f"{RECORD_PREFIX}{photo_id // BUCKET_SIZE}", photo_id % BUCKET_SIZE
+
+
+def names_key(dir_id):
+    return f"photo:names:{dir_id}"
+
+
+def _int(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def pack(record):
+    gps = record.get('gps')
+    flags = (FAVORITE if record.get('favorite') else 0) | (HAS_GPS if gps else 0)
+    lat, lon = (round(gps[0] * 1e5), round(gps[1] * 1e5)) if gps else (0, 0)
+    phash = record.get('phash')
+    out = bytearray(HEADER.pack(
+        int(record['dir']), _int(record.get('gen')), _int(record.get('epoch')), flags,
+        _int(record.get('orientation')), _int(record.get('width')), _int(record.get('height')),
+        _int(record.get('size')), lat, lon, _int(record.get('file_id')),
+        int(phash, 16) if phash else 0, _int(record.get('cluster')),
+    ))
+    for name in STRINGS:
+        raw = (record.get(name) or '').encode('utf-8')[:255]
+        out += bytes([len(raw)]) + raw
+    return bytes(out)
+
+
+def unpack(raw):
+    (dir_id, gen, epoch, flags, orientation, width, height, size, lat, lon,
+     file_id, phash, cluster) = HEADER.unpack_from(raw, 0)
+    record = {
+        'dir': dir_id,
+        'gen': gen,
+        'epoch': epoch,
+        'favorite': bool(flags & FAVORITE),
+        'size': size,
+    }
+    pos = HEADER.size
+    for name in STRINGS:
+        length = raw[pos]
+        record[name] = raw[pos + 1:pos + 1 + length].decode('utf-8', errors='ignore')
+        pos += 1 + length
+    # Unknown values are left out, like the fields of the old per-photo hashes
+    for name in STRINGS[2:]:
+        if not record[name]:
+            del record[name]
+    if width and height:
+        record['width'], record['height'] = width, height
+    if orientation and orientation != 1:
+        record['orientation'] = orientation
+    if flags & HAS_GPS:
+        record['gps'] = (lat / 1e5, lon / 1e5)
+    if file_id:
+        record['file_id'] = str(file_id)
+    if phash:
+        record['phash'] = f"{phash:016x}"
+    if cluster:
+        record['cluster'] = str(cluster)
+    return record
+
+
+def dir_ids(r, paths, create=False):
+    # Directory ids for paths, None for unknown directories unless create is set
+    paths = [normalize_dir(path) for path in paths]
+    missing = list(dict.fromkeys(path for path in paths if path not in _dir_ids))
+    if missing:
+        for path, found in zip(missing, r.hmget(DIRS_KEY, missing)):
+            if found is None and create:
+                found = r.eval(INTERN_DIR, 3, DIRS_KEY, DIR_PATHS_KEY, NEXT_DIR_KEY, path)
+            if found is not None:
+                _dir_ids[path] = int(found)
+                _dir_paths[int(found)] = path
+    return [_dir_ids.get(path) for path in paths]
+
+
+def dir_paths(r, ids):
+    ids = [int(i) for i in ids]
+    missing = list(dict.fromkeys(i for i in ids if i not in _dir_paths))
+    if missing:
+        for dir_id, path in zip(missing, r.hmget(DIR_PATHS_KEY, missing)):
+            if path is not None:
+                _dir_paths[dir_id] = path
+                _dir_ids[path] = dir_id
+    return [_dir_paths.get(i) for i in ids]
+
+
+def find(r, paths):
+    # Photo ids for file paths (None if unknown), one pipelined round trip once the directories are cached
+    parts = [split(path) for path in paths]
+    dirs = dir_ids(r, [directory for directory, _ in parts])
+    pipe = r.pipeline(transaction=False)
+    for dir_id, (_, name) in zip(dirs, parts):
+        if dir_id is not None:
+            pipe.hget(names_key(dir_id), name)
+    found = iter(pipe.execute())
+    ids = []
+    for dir_id in dirs:
+        photo_id = next(found) if dir_id is not None else None
+        ids.append(int(photo_id) if photo_id else None)
+    return ids
+
+
+def decode(r, items):
+    # (photo id, packed record or None) pairs -> records with id and path, None where missing
+    records = []
+    for photo_id, raw in items:
+        record = None
+        if raw:
+            record = unpack(raw)
+            record['id'] = str(photo_id)
+        records.append(record)
+    known = [record for record in records if record]
+    for record, directory in zip(known, dir_paths(r, [record['dir'] for record in known])):
+        record['path'] = join(directory or '', record['name'])
+    return records
+
+
+def get(r, ids):
+    # Records for photo ids; ids that are not numeric (e.g. keys of the old layout) read as None
+    ids = list(ids)
+    pipe = r.pipeline(transaction=False)
+    valid = []
+    for photo_id in ids:
+        if str(photo_id).isdigit():
+            pipe.execute_command('HGET', *record_field(photo_id), **{NEVER_DECODE: True})
+            valid.append(photo_id)
+    raws = dict(zip(valid, pipe.execute())) if valid else {}
+    return decode(r, [(photo_id, raws.get(photo_id)) for photo_id in ids])
+
+
+def put(pipe, photo_id, record):
+    # record needs 'dir' and 'name'; replaces the whole record
+    pipe.hset(*record_field(photo_id), pack(record))
+    pipe.hset(names_key(record['dir']), record['name'], photo_id)
+
+
+def remove(pipe, photo_id, record):
+    pipe.hdel(*record_field(photo_id))
+    pipe.eval(REMOVE_NAME, 1, names_key(record['dir']), record['name'], str(photo_id))
+    pipe.zrem("photo_pool", photo_id)
+
+
+def update(r, photo_id, **fields):
+    # Change single fields (pre-warmed hashes, geocoded places, clusters) while the
+    # scanner may be writing the same record: the new value is only stored if the
+    # record still is the one it was derived from, otherwise it is read again.
+    key, field = record_field(photo_id)
+    for _ in range(UPDATE_RETRIES):
+        raw = r.execute_command('HGET', key, field, **{NEVER_DECODE: True})
+        if not raw:
+            return None
+        record = decode(r, [(photo_id, raw)])[0]
+        record.update(fields)
+        if r.eval(SWAP_RECORD, 1, key, field, raw, pack(record)):
+            return record
+    return None
+
+
+def allocate(r, count):
+    # New photo ids; only the worker creates photos
+    last = r.incrby(NEXT_ID_KEY, count)
+    return list(range(last - count + 1, last + 1))
+
+
+def migrate(r):
+    # Convert photo:<path> hashes of older versions into compact records.
+    # Returns the number of photos migrated. Worker replicas starting together must
+    # not both allocate ids for the same photos: one migrates, the others wait for it.
+    while r.get(SCHEMA_KEY) != SCHEMA_VERSION:
+        if r.set(MIGRATE_LOCK, 1, nx=True, ex=MIGRATE_LOCK_SECONDS):
+            try:
+                # Another replica may have finished between the check and the lock
+                return _migrate(r) if r.get(SCHEMA_KEY) != SCHEMA_VERSION else 0
+            finally:
+                r.delete(MIGRATE_LOCK)
+        time.sleep(1)
+    return 0
+
+
+def _migrate(r):
+    import geocoder
+    import selection
+
+    old_keys = [key for key, _ in r.zscan_iter("photo_pool", match="photo:*", count=BATCH_SIZE)]
+    if not old_keys:
+        r.set(SCHEMA_KEY, SCHEMA_VERSION)
+        return 0
+    for start in range(0, len(old_keys), BATCH_SIZE):
+        r.expire(MIGRATE_LOCK, MIGRATE_LOCK_SECONDS)
+        keys = old_keys[start:start + BATCH_SIZE]
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        rows = [(key, row) for key, row in zip(keys, pipe.execute()) if row.get('path')]
+        dirs = dir_ids(r, [split(row['path'])[0] for _, row in rows], create=True)
+
+        pipe = r.pipeline(transaction=False)
+        for (key, row), dir_id, photo_id in zip(rows, dirs, allocate(r, len(rows)) if rows else []):
+            epoch = selection.capture_epoch(row.get('timestamp'))
+            record = dict(row, dir=dir_id, name=split(row['path'])[1], epoch=epoch,
+                          favorite=row.get('favorite') == '1', gps=geocoder.parse_gps(row.get('gps')))
+            # Clusters are recomputed by the index rebuild below
+            record.pop('cluster', None)
+            put(pipe, photo_id, record)
+            pipe.zadd("photo_pool", {photo_id: epoch})
+        pipe.zrem("photo_pool", *keys)
+        pipe.delete(*keys)
+        pipe.execute()
+
+    # Per-display lists refer to photos by key: map them to ids
+    for key in list(r.scan_iter(match="history:*")) + list(r.scan_iter(match="prefetch:*")):
+        items = r.lrange(key, 0, -1)
+        ids = _ids_for_keys(r, items)
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(key)
+        if ids:
+            pipe.rpush(key, *ids)
+        pipe.execute()
+    for key in r.scan_iter(match="display:*"):
+        current = r.hget(key, "current")
+        if current and not current.isdigit():
+            ids = _ids_for_keys(r, [current])
+            if ids:
+                r.hset(key, "current", ids[0])
+            else:
+                r.hdel(key, "current")
+    # Directory file lists held photo keys: dropping the directory records makes the
+    # next scan list every folder once (unchanged photos are still not downloaded)
+    for pattern in ("dir:*", "dir_files:*", "dir_subdirs:*"):
+        keys = list(r.scan_iter(match=pattern, count=BATCH_SIZE))
+        for start in range(0, len(keys), BATCH_SIZE):
+            r.delete(*keys[start:start + BATCH_SIZE])
+    r.delete("render:queue", "stats:scanned_paths")
+
+    selection.rebuild_index(r)
+    r.set(SCHEMA_KEY, SCHEMA_VERSION)
+    return len(old_keys)
+
+
+def _ids_for_keys(r, keys):
+    paths = [key[len("photo:"):] for key in keys if key.startswith("photo:")]
+    found = find(r, paths) if paths else []
+    return [key for key in keys if key.isdigit()] + [str(i) for i in found if i]
+
+
+def key_group(key):
+    # "photo:rec:12" -> "photo:rec:*", "photo:/Photos/a.jpg" -> "photo:*"
+    parts = key.split(':')
+    group = [parts[0]]
+    for part in parts[1:]:
+        if not re.fullmatch(r'[a-z_]+', part):
+            group.append('*')
+            break
+        group.append(part)
+    return ':'.join(group)
+
+
+def memory_report(r, out=sys.stdout):
+    # MEMORY USAGE of every key, summed per key group and divided by the number of
+    # photos. Run it before and after migrating to compare the two layouts.
+    groups = {}
+    keys = list(r.scan_iter(count=1000))
+    for start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[start:start + BATCH_SIZE]
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.memory_usage(key, samples=0)
+        for key, used in zip(batch, pipe.execute()):
+            count, total = groups.get(key_group(key), (0, 0))
+            groups[key_group(key)] = (count + 1, total + (used or 0))
+
+    count = r.zcard("photo_pool")
+    total = sum(used for _, used in groups.values())
+    print(f"{count} photos, {len(keys)} keys, {total / 1024 / 1024:.1f} MB", file=out)
+    if count:
+        print(f"{total / count:.0f} bytes per photo", file=out)
+    for group, (keys_in_group, used) in sorted(groups.items(), key=lambda item: -item[1][1]):
+        per_photo = f"{used / count:8.1f} B/photo" if count else ""
+        print(f"  {group:32} {keys_in_group:8} keys {used / 1024:12.1f} KB {per_photo}", file=out)
+    return total, count
+
+
+if __name__ == "__main__":
+    # python photos.py migrate | memory
+    import redis
+    client = redis.Redis(host=os.getenv('REDIS_HOST'), port=6379, decode_responses=True)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'memory'
+    if command == 'migrate':
+        print(f"Migrated {migrate(client)} photos")
+    else:
+        memory_report(client)
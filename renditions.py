@@ -0,0 +1,297 @@
+import io
+import os
+import sys
+import math
+import time
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+import requests
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import namedtuple
+from PIL import Image, ImageOps, ImageFilter, ImageEnhance
+
+# On-disk cache of display-sized, EXIF-transposed renditions.
+# Shared by the web app (serving) and the scanner (optional pre-warming).
+
+NC_URL = os.getenv('NC_URL', '').rstrip('/')
+NC_USER = os.getenv('NC_USER')
+NC_PASS = os.getenv('NC_PASS')
+# Nextcloud web base URL (for the preview API), derived from the WebDAV URL
+NC_BASE_URL = NC_URL.split('/remote.php')[0]
+
+# Where renditions are made from: 'preview' asks Nextcloud's preview API for a
+# display-sized image by file id and falls back to the original when no preview is
+# available; 'original' always downloads the full file.
+SOURCE = os.getenv('RENDITION_SOURCE', 'preview').lower()
+
+CACHE_DIR = os.getenv('RENDITION_CACHE_DIR', '/app/cache/renditions')
+CACHE_MAX_BYTES = int(os.getenv('RENDITION_CACHE_MAX_MB', '1024')) * 1024 * 1024
+QUALITY = int(os.getenv('RENDITION_QUALITY', '85'))
+MAX_AGE = int(os.getenv('RENDITION_MAX_AGE', '86400'))
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+}
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+DISPLAY_SIZE = parse_size(os.getenv('RENDITION_SIZE', '1920x1080'))
+FORMAT = os.getenv('RENDITION_FORMAT', 'jpeg').lower()
+if FORMAT not in FORMATS:
+    FORMAT = 'jpeg'
+
+# Tiny, pre-blurred and darkened rendition for the page background.
+# Stretched with background-size: cover it looks like the old CSS blur at a fraction of the cost.
+BACKGROUND_SIZE = (64, 64)
+BACKGROUND_BLUR = 2
+BACKGROUND_BRIGHTNESS = 0.5
+
+Rendition = namedtuple('Rendition', ['key', 'path', 'data', 'mimetype'])
+
+session = requests.Session()
+session.auth = (NC_USER, NC_PASS)
+# Keep-alive connections shared by all threads of the process (render workers, scanner)
+_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+# Processes per web/worker process that decode and encode renditions (0 = render in the calling thread)
+RENDER_PROCESSES = int(os.getenv('RENDER_PROCESSES', '1'))
+
+_lock = threading.Lock()
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(1, RENDER_PROCESSES) * 2)
+# Bytes written since the last eviction pass (per process)
+_written = CACHE_MAX_BYTES
+
+def cache_key(path, etag, size, fmt):
+    raw = f"{path}\0{etag}\0{size[0]}x{size[1]}\0{fmt}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def cache_path(key, fmt):
+    return os.path.join(CACHE_DIR, key[:2], key + FORMATS[fmt][2])
+
+def fetch_original(path):
+    # Stream the original into a spooled temp file instead of holding the response body
+    url = NC_URL + '/' + path.lstrip('/')
+    resp = session.get(url, stream=True, timeout=60)
+    resp.raise_for_status()
+    source = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    for chunk in resp.iter_content(chunk_size=64 * 1024):
+        source.write(chunk)
+    source.seek(0)
+    return source
+
+def fetch_preview(file_id, size):
+    # Nextcloud renders (and keeps) a preview that fits into size; None if there is none,
+    # e.g. previews are disabled or the file type has no preview provider
+    params = {'fileId': file_id, 'x': size[0], 'y': size[1], 'a': 1, 'forceIcon': 0}
+    try:
+        resp = session.get(NC_BASE_URL + '/index.php/core/preview', params=params, timeout=60)
+    except requests.RequestException as e:
+        print(f"Preview request failed for file {file_id}: {e}", file=sys.stderr)
+        return None
+    if resp.status_code != 200 or not resp.headers.get('Content-Type', '').startswith('image/'):
+        return None
+    return io.BytesIO(resp.content)
+
+def fetch_source(path, file_id, size):
+    if SOURCE == 'preview' and file_id:
+        source = fetch_preview(file_id, size)
+        if source is not None:
+            return source
+    return fetch_original(path)
+
+def _target_box(image, size):
+    # Box in the image's stored orientation: EXIF orientations 5-8 are rotated 90 degrees
+    if image.getexif().get(0x0112) in (5, 6, 7, 8):
+        return size[1], size[0]
+    return size
+
+def render(source, size, fmt):
+    started = time.perf_counter()
+    image = Image.open(source)
+    original_size = image.size
+    box = _target_box(image, size)
+    # JPEG: decode at 1/2, 1/4 or 1/8 scale (DCT scaling) as long as the result still
+    # covers the target size, then shrink and only rotate the small image
+    scale = min(box[0] / image.width, box[1] / image.height)
+    if scale < 1:
+        image.draft(image.mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    decoded_size = image.size
+    image.thumbnail(box, Image.Resampling.LANCZOS)
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    out = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+    image.save(out, format=FORMATS[fmt][0], quality=QUALITY)
+    out.seek(0)
+    data = out.read()
+    print(f"Rendered {original_size[0]}x{original_size[1]} (decoded at {decoded_size[0]}x{decoded_size[1]}) "
+          f"-> {image.width}x{image.height} {fmt}, {source_size(source) // 1024} KB -> {len(data) // 1024} KB "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms", file=sys.stderr)
+    return data
+
+def source_size(source):
+    try:
+        return source.seek(0, os.SEEK_END)
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+def _render_bytes(function, data, *args):
+    # Runs in a pool process: the source crosses the process boundary as bytes
+    return function(io.BytesIO(data), *args)
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the web and worker processes are multi-threaded, forking them is unsafe
+            _pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def run_render(function, source, *args):
+    # Decoding and encoding are CPU bound and hold the GIL, so they run in a small
+    # process pool; at most 2 renders per pool process wait with their source in memory.
+    if RENDER_PROCESSES <= 0:
+        return function(source, *args)
+    global _pool
+    with _slots:
+        data = source.read()
+        try:
+            return _get_pool().submit(_render_bytes, function, data, *args).result()
+        except BrokenProcessPool:
+            # A render process died (e.g. out of memory); start a fresh pool next time
+            with _pool_lock:
+                _pool = None
+            raise
+
+def render_background(source):
+    image = Image.open(source)
+    # JPEG sources can be decoded at reduced scale directly
+    image.draft(image.mode, (BACKGROUND_SIZE[0] * 4, BACKGROUND_SIZE[1] * 4))
+    image.thumbnail(_target_box(image, BACKGROUND_SIZE), Image.Resampling.BILINEAR)
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image = image.filter(ImageFilter.GaussianBlur(BACKGROUND_BLUR))
+    image = ImageEnhance.Brightness(image).enhance(BACKGROUND_BRIGHTNESS)
+
+    out = tempfile.SpooledTemporaryFile()
+    image.save(out, format='JPEG', quality=70)
+    out.seek(0)
+    return out.read()
+
+def write_atomic(target, data):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, target)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+def evict():
+    # LRU by mtime: hits touch the file, so the oldest mtimes are the least recently used
+    entries = []
+    total = 0
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            full = os.path.join(root, name)
+            try:
+                st = os.stat(full)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+            total += st.st_size
+
+    if total <= CACHE_MAX_BYTES:
+        return 0
+
+    removed = 0
+    target = int(CACHE_MAX_BYTES * 0.9)
+    for _, size, full in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.unlink(full)
+            total -= size
+            removed += 1
+        except FileNotFoundError:
+            pass
+    print(f"Rendition cache: evicted {removed} files", file=sys.stderr)
+    return removed
+
+def _account(nbytes):
+    global _written
+    with _lock:
+        _written += nbytes
+        if _written < CACHE_MAX_BYTES // 20:
+            return
+        _written = 0
+    evict()
+
+def _cached(target, produce):
+    try:
+        os.utime(target)
+        return target
+    except FileNotFoundError:
+        pass
+
+    data = produce()
+    write_atomic(target, data)
+    _account(len(data))
+    return target
+
+def get_rendition(path, etag, size=DISPLAY_SIZE, fmt=FORMAT, file_id=None):
+    mimetype = FORMATS[fmt][1]
+    if not etag:
+        # Without an etag there is no safe cache key; render without caching
+        with fetch_source(path, file_id, size) as source:
+            return Rendition(None, None, run_render(render, source, size, fmt), mimetype)
+
+    def produce():
+        with fetch_source(path, file_id, size) as source:
+            return run_render(render, source, size, fmt)
+
+    key = cache_key(path, etag, size, fmt)
+    return Rendition(key, _cached(cache_path(key, fmt), produce), None, mimetype)
+
+def cached_rendition(path, etag):
+    # Path of the display rendition if it is in the cache, without rendering it
+    if not etag:
+        return None
+    display = cache_path(cache_key(path, etag, DISPLAY_SIZE, FORMAT), FORMAT)
+    return display if os.path.exists(display) else None
+
+def get_background(path, etag, file_id=None):
+    mimetype = FORMATS['jpeg'][1]
+    # A small preview is plenty for a 64x64 blurred background
+    preview_size = (BACKGROUND_SIZE[0] * 4, BACKGROUND_SIZE[1] * 4)
+    if not etag:
+        with fetch_source(path, file_id, preview_size) as source:
+            return Rendition(None, None, run_render(render_background, source), mimetype)
+
+    def produce():
+        # Derive from the cached display rendition when possible instead of the original
+        display = cache_path(cache_key(path, etag, DISPLAY_SIZE, FORMAT), FORMAT)
+        try:
+            with open(display, 'rb') as source:
+                return render_background(source)
+        except FileNotFoundError:
+            pass
+        with fetch_source(path, file_id, preview_size) as source:
+            return run_render(render_background, source)
+
+    key = cache_key(path, etag, BACKGROUND_SIZE, 'background')
+    return Rendition(key, _cached(cache_path(key, 'jpeg'), produce), None, mimetype)
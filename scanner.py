@@ -4,13 +4,21 @@ import redis
 import requests
 import logging
 import sys
-import io
 import re
-from webdav3.client import Client
-from PIL import Image, ExifTags
-from datetime import datetime, timedelta
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse, unquote
+from datetime import datetime
+from collections import namedtuple
 from croniter import croniter
 from concurrent.futures import ThreadPoolExecutor
+import renditions
+import selection
+import photos
+import photo_metadata
+import geocoder
+import weather
+import limiter
 
 # Configure logging
 logging.basicConfig(
@@ -25,12 +33,6 @@ NC_URL = os.getenv('NC_URL').rstrip('/')
 NC_USER = os.getenv('NC_USER')
 NC_PASS = os.getenv('NC_PASS')
 
-NC_OPTIONS = {
-    'webdav_hostname': NC_URL,
-    'webdav_login':    NC_USER,
-    'webdav_password': NC_PASS
-}
-client = Client(NC_OPTIONS)
 r = redis.Redis(host=os.getenv('REDIS_HOST'), port=6379, decode_responses=True)
 
 # Shared session for efficiency
@@ -38,98 +40,157 @@ session = requests.Session()
 session.auth = (NC_USER, NC_PASS)
 
 IGNORE_FILE = os.getenv('IGNORE_FILE', '.ignore')
-MAX_WORKERS = int(os.getenv('SCANNER_PARALLEL', '4'))
+# Upper bound; the adaptive limiter (limiter.py) finds the rate Nextcloud can take
+MAX_WORKERS = int(os.getenv('SCANNER_PARALLEL', '16'))
+# Every request to Nextcloud goes through nc_limiter (see limiter.request)
+nc_limiter = limiter.Limiter(MAX_WORKERS)
+RENDITION_PREWARM = os.getenv('RENDITION_PREWARM', 'false').lower() == 'true'
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '1'))
+# Preview size perceptual hashes are computed from when a photo has no EXIF thumbnail
+HASH_PREVIEW_SIZE = (64, 64)
+SWEEP_BATCH = 500
+# Files per thread pool job; each job does one pipelined read and one pipelined write
+FILE_BATCH = 50
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.webp', '.png')
+# threads: blocking requests on a thread pool; async: asyncio/aiohttp (see async_scanner.py);
+# distributed: Redis-backed frontier shared by all worker replicas (see distributed_scanner.py)
+SCANNER_MODE = os.getenv('SCANNER_MODE', 'threads').lower()
+# Poll for changes every SYNC_INTERVAL seconds between full scans (0 = cron scans only)
+SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', '0'))
 
-def get_exif_data_from_bytes(data):
-    try:
-        img = Image.open(io.BytesIO(data))
-        # Use getexif() instead of _getexif() for better format support (WebP, etc)
-        exif_raw = img.getexif()
-        if not exif_raw:
-            return "Unknown", "Unknown"
-            
-        exif = { ExifTags.TAGS[k]: v for k, v in exif_raw.items() if k in ExifTags.TAGS }
-        
-        # Date taken is often in tag 36867 (DateTimeOriginal) 
-        # but Tags mapping is more robust
-        date_taken = exif.get('DateTimeOriginal', 'Unknown')
-        if date_taken == "Unknown":
-            # Fallback to other date tags
-            date_taken = exif.get('DateTime', 'Unknown')
-        
-        # GPS
-        gps_coords = "Present" if 34853 in exif_raw else "Unknown"
-            
-        return date_taken, gps_coords
-    except Exception as e:
-        return "Unknown", "Unknown"
+# WebDAV PROPFIND for favorite, fileid, getetag, getcontentlength and resourcetype.
+# With Depth: 1 a single request returns these for a directory and all its children.
+PROPFIND_BODY = (
+    '<?xml version="1.0"?>'
+    '<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns"><d:prop>'
+    '<oc:favorite/><oc:fileid/><d:getetag/><d:getcontentlength/><d:resourcetype/>'
+    '</d:prop></d:propfind>'
+)
+# Favoriting a file changes neither its etag nor its folder's, so pruned subtrees would
+# keep stale flags: every scan also asks for all favorites with one REPORT.
+FAVORITES_BODY = (
+    '<?xml version="1.0"?>'
+    '<oc:filter-files xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+    '<d:prop><oc:favorite/><oc:fileid/><d:getetag/><d:resourcetype/></d:prop>'
+    '<oc:filter-rules><oc:favorite>1</oc:favorite></oc:filter-rules>'
+    '</oc:filter-files>'
+)
+DAV_NS = {'d': 'DAV:', 'oc': 'http://owncloud.org/ns'}
+# hrefs in PROPFIND responses are absolute (/remote.php/dav/files/<user>/...)
+DAV_ROOT = unquote(urlparse(NC_URL).path).rstrip('/')
 
-def get_metadata(file_path):
-    # WebDAV PROPFIND for favorite, fileid, getetag, and getcontentlength
-    xml_data = '<?xml version="1.0"?><d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns"><d:prop><oc:favorite/><oc:fileid/><d:getetag/><d:getcontentlength/></d:prop></d:propfind>'
-    try:
-        url = NC_URL + '/' + file_path.lstrip('/')
-        resp = session.request("PROPFIND", url, data=xml_data, headers={'Depth': '0'})
-        resp.raise_for_status()
-        
-        is_fav = "<oc:favorite>1</oc:favorite>" in resp.text
-        
-        file_id = None
-        match_id = re.search(r'<oc:fileid>(.*?)</oc:fileid>', resp.text)
-        if match_id:
-            file_id = match_id.group(1)
-            
-        etag = None
-        match_etag = re.search(r'<d:getetag>(.*?)</d:getetag>', resp.text)
-        if match_etag:
-            etag = match_etag.group(1).strip('"')
-            
-        size = 0
-        match_size = re.search(r'<d:getcontentlength>(.*?)</d:getcontentlength>', resp.text)
-        if match_size:
-            size = int(match_size.group(1))
+def href_to_path(href):
+    # Translate a PROPFIND href back into a path relative to NC_URL
+    path = unquote(urlparse(href).path)
+    if path.startswith(DAV_ROOT):
+        path = path[len(DAV_ROOT):]
+    return path or '/'
 
-        return is_fav, file_id, etag, size
-    except Exception as e:
-        logger.error(f"Metadata error for {file_path}: {e}")
-        return False, None, None, 0
+def parse_propfind(content):
+    entries = []
+    root = ET.fromstring(content)
+    for response in root.findall('d:response', DAV_NS):
+        href = response.findtext('d:href', default='', namespaces=DAV_NS)
+        prop = None
+        for propstat in response.findall('d:propstat', DAV_NS):
+            status = propstat.findtext('d:status', default='', namespaces=DAV_NS)
+            if ' 200 ' in status:
+                prop = propstat.find('d:prop', DAV_NS)
+                break
+        if prop is None:
+            continue
 
-def process_file(file):
-    r.incr("stats:last_scan_found")
-    if not file.lower().endswith(('.jpg', '.jpeg', '.webp', '.png')):
-        return
-    
-    # 1. Fetch metadata and check cache
-    is_fav, file_id, etag, size = get_metadata(file)
-    
-    cached = r.hgetall(f"photo:{file}")
-    if cached and cached.get('etag') == etag and etag:
-        # Skip download and processing if etag matches
-        # Just update the pool to ensure it's still there
-        r.zadd("photo_pool", {f"photo:{file}": int(cached.get('weight', 10))})
-        # Add a very infrequent log or just don't log at all for huge speed
-        # But for debugging, let's keep it visible
-        if r.incr("stats:logs_skipped") % 100 == 0:
-             logger.info(f"Skipped {file} (cached and unchanged)...")
-        return
+        etag = (prop.findtext('d:getetag', default='', namespaces=DAV_NS) or '').strip('"')
+        size = prop.findtext('d:getcontentlength', default='', namespaces=DAV_NS)
+        entries.append({
+            'path': href_to_path(href),
+            'is_dir': prop.find('d:resourcetype/d:collection', DAV_NS) is not None,
+            'favorite': prop.findtext('oc:favorite', default='', namespaces=DAV_NS) == '1',
+            'file_id': prop.findtext('oc:fileid', default='', namespaces=DAV_NS) or None,
+            'etag': etag or None,
+            'size': int(size) if size and size.isdigit() else 0,
+        })
+    return entries
 
-    # 2. Prefer partial download for EXIF (Fetch first 256KB)
-    url = NC_URL + '/' + file.lstrip('/')
-    timestamp = "Unknown"
-    gps = "Unknown"
-    
-    try:
-        # Most EXIF data is in the first few KB
-        # Fetching 256KB is usually enough even for WebP with chunks
-        resp = session.get(url, headers={'Range': 'bytes=0-262143'})
-        if resp.status_code in [200, 206]:
-            timestamp, gps = get_exif_data_from_bytes(resp.content)
-    except Exception as e:
-        logger.error(f"Error reading EXIF for {file}: {e}")
+def propfind(path, depth):
+    url = NC_URL + '/' + path.lstrip('/')
+    resp = limiter.request(nc_limiter, session, "PROPFIND", url, data=PROPFIND_BODY, headers={'Depth': str(depth)})
+    resp.raise_for_status()
+    return parse_propfind(resp.content)
+
+def list_directory(path):
+    # One Depth: 1 PROPFIND returns the directory itself plus metadata for every child
+    entries = propfind(path, 1)
+    own = path.rstrip('/')
+    directory = None
+    children = []
+    for entry in entries:
+        if entry['path'].rstrip('/') == own:
+            directory = entry
+        else:
+            children.append(entry)
+    return directory, children
+
+class ScanStats:
+    # Scan counters are accumulated locally by all threads and flushed to the
+    # stats:last_scan_* keys in one pipeline every FLUSH_INTERVAL seconds.
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, prefix="stats:last_scan_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.totals = {}
+        self.last_flush = time.monotonic()
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.pending[name] = self.pending.get(name, 0) + amount
+            self.totals[name] = self.totals.get(name, 0) + amount
+            total = self.totals[name]
+            due = time.monotonic() - self.last_flush >= self.FLUSH_INTERVAL
+        if due:
+            self.flush()
+        return total
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if pending:
+            pipe = r.pipeline(transaction=False)
+            for name, amount in pending.items():
+                pipe.incrby(f"{self.prefix}{name}", amount)
+            pipe.execute()
+
+class Scan:
+    # State shared by one run_scan(): generation id, thread pool, counters and the
+    # directory etags to record once the scan has finished
+    def __init__(self, generation, executor, stats_prefix="stats:last_scan_"):
+        self.generation = generation
+        self.executor = executor
+        self.stats = ScanStats(stats_prefix)
+        self.dir_records = {}
+        self.ignored = set()  # Directories skipped because of IGNORE_FILE
+        self.failed = set()  # Directories with a file batch that failed (see discard_failed)
+
+def store_cached(file, meta, cached, pipe, scan):
+    # Skip download and processing if etag matches
+    # Just update the pool to ensure it's still there
+    pipe.zadd("photo_pool", {cached['id']: cached['epoch']})
+    # Mark as seen in this scan; favoriting a file does not change its etag
+    cached.update(gen=scan.generation, favorite=meta['favorite'])
+    photos.put(pipe, cached['id'], cached)
+    # Add a very infrequent log or just don't log at all for huge speed
+    # But for debugging, let's keep it visible
+    if scan.stats.incr("skipped") % 100 == 0:
+         logger.info(f"Skipped {file} (cached and unchanged)...")
+
+def store_photo(file, photo_id, meta, info, pipe, scan):
+    # Queue the record of a new or changed photo; info is the photo_metadata.Metadata read for it
+    is_fav, file_id, etag, size = meta['favorite'], meta['file_id'], meta['etag'], meta['size']
+    timestamp = info.timestamp if info else "Unknown"
 
-    # 3. Calculate Weight
-    weight = 10 
-    
     # Fallback: Try to parse date from folder path if EXIF is missing
     if timestamp == "Unknown":
         # Look for YYYY-MM-DD or YYYYMMDD in path (greedy check)
@@ -141,78 +202,476 @@ def process_file(file):
                 timestamp = f"{y}:{m}:{d} 12:00:00"
                 logger.debug(f"Guessed date from path for {file}: {timestamp}")
 
-    if timestamp != "Unknown":
+    # Store raw attributes in Redis; weights are computed by selection.py at pick time
+    directory, name = photos.split(file)
+    epoch = selection.capture_epoch(timestamp)
+    record = {
+        "dir": photos.dir_ids(r, [directory], create=True)[0],
+        "name": name,
+        "epoch": epoch,
+        "favorite": is_fav,
+        "file_id": file_id,
+        "etag": etag,
+        "size": size,
+        "gen": scan.generation
+    }
+    # Optional fields are only stored when known (orientation only when not 1 = upright)
+    if info:
+        if info.width and info.height:
+            record["width"], record["height"] = info.width, info.height
+        if info.orientation and info.orientation != 1:
+            record["orientation"] = info.orientation
+        if info.gps:
+            record["gps"] = info.gps
+            place = geocoder.lookup(*info.gps)
+            if place:
+                record["place"], record["country"] = place
+        if info.camera:
+            record["camera"] = info.camera
+        phash = photo_metadata.thumbnail_hash(info)
+        if phash:
+            record["phash"] = phash
+
+    # The content changed, so the whole record is replaced and everything derived
+    # from the old version (cluster, geocoded place) is dropped
+    photos.put(pipe, photo_id, record)
+    # photo_pool is scored by capture time (0 = unknown)
+    pipe.zadd("photo_pool", {photo_id: epoch})
+    scan.stats.incr("processed")
+    logger.info(f"Processed {file}: Date={timestamp}, Favorite={is_fav}, Size={record.get('width')}x{record.get('height')}")
+
+def prewarm(file, etag, file_id=None):
+    # Optionally render the display rendition now so the frame never waits for it.
+    # Returns the cached rendition's path, None if rendering failed.
+    try:
+        # Takes a slot of the limiter, so pre-warming counts against the request limit
+        with nc_limiter:
+            rendition = renditions.get_rendition(file, etag, file_id=file_id)
+            renditions.get_background(file, etag, file_id)
+        return rendition.path
+    except Exception as e:
+        logger.error(f"Rendition pre-warm failed for {file}: {e}")
+        return None
+
+def preview_hash(file, etag, file_id=None):
+    # Perceptual hash for photos without an EXIF thumbnail (PNG, WebP, some JPEGs), from
+    # a cached rendition or a small Nextcloud preview. The original is never downloaded
+    # for it: without either, the render worker hashes the photo once it is rendered.
+    rendition = renditions.cached_rendition(file, etag)
+    if rendition:
+        return photo_metadata.image_hash(rendition)
+    if renditions.SOURCE != 'preview' or not file_id:
+        return None
+    try:
+        with nc_limiter:
+            source = renditions.fetch_preview(file_id, HASH_PREVIEW_SIZE)
+        if source is None:
+            return None
+        with source:
+            return photo_metadata.image_hash(source)
+    except Exception as e:
+        logger.error(f"Could not hash {file}: {e}")
+        return None
+
+def finish_changed(changed):
+    # (entry, photo id) of the new and changed photos of a batch, after their records
+    # were written: pre-warm renditions and hash what the EXIF thumbnail did not cover
+    records = photos.get(r, [photo_id for _, photo_id in changed])
+    for (entry, photo_id), record in zip(changed, records):
+        rendition = None
+        if RENDITION_PREWARM and entry['etag']:
+            rendition = prewarm(entry['path'], entry['etag'], entry['file_id'])
+        if record and not record.get('phash') and selection.DUPLICATE_DISTANCE > 0:
+            # A pre-warmed rendition is already upright and local
+            phash = photo_metadata.image_hash(rendition) if rendition else preview_hash(entry['path'], entry['etag'], entry['file_id'])
+            if phash:
+                photos.update(r, photo_id, phash=phash)
+
+def range_fetcher(file):
+    url = NC_URL + '/' + file.lstrip('/')
+
+    def fetch(start, end):
+        resp = limiter.request(nc_limiter, session, "GET", url, headers={'Range': f'bytes={start}-{end}'})
+        resp.raise_for_status()
+        return start, resp.content, resp.status_code == 200
+    return fetch
+
+def process_file(file, photo_id, meta, cached, pipe, scan):
+    # cached is the stored record (None for new photos); writes go to the batch pipeline
+    if cached and cached['etag'] and cached['etag'] == meta['etag']:
+        store_cached(file, meta, cached, pipe, scan)
+        return False
+
+    # Read EXIF with as few and as small range requests as the file layout allows
+    info = None
+    try:
+        info = photo_metadata.read(range_fetcher(file), meta['size'] or None)
+    except Exception as e:
+        logger.error(f"Error reading EXIF for {file}: {e}")
+
+    store_photo(file, photo_id, meta, info, pipe, scan)
+    return True
+
+def load_batch(entries):
+    # (photo id, stored record) per entry; files seen for the first time get new ids
+    paths = [entry['path'] for entry in entries]
+    # Interned up front, so storing the records needs no further lookups
+    photos.dir_ids(r, [photos.split(path)[0] for path in paths], create=True)
+    ids = photos.find(r, paths)
+    known = [photo_id for photo_id in ids if photo_id]
+    cached = dict(zip(known, photos.get(r, known)))
+    new = iter(photos.allocate(r, len(ids) - len(known)) if len(known) < len(ids) else [])
+    return [(photo_id, cached[photo_id]) if photo_id else (next(new), None) for photo_id in ids]
+
+def process_batch(entries, scan):
+    # One pipelined cache lookup and one pipelined write per batch of files
+    # instead of several round trips per photo.
+    scan.stats.incr("found", len(entries))
+    files = [e for e in entries if e['path'].lower().endswith(PHOTO_EXTENSIONS)]
+    if not files:
+        return
+
+    loaded = load_batch(files)
+
+    changed = []
+    pipe = r.pipeline(transaction=False)
+    for entry, (photo_id, cached) in zip(files, loaded):
         try:
-            dt = datetime.strptime(timestamp, "%Y:%m:%d %H:%M:%S")
-            age_years = (datetime.now() - dt).days / 365.0
-            # Exponential decay: Newer photos are much more likely, 
-            # but older photos still appear occasionally.
-            weight = int(100 * (0.85 ** max(0, age_years)))
-            
-            # "Memory of the day" bonus: 10x weight if month and day match today
-            now = datetime.now()
-            if dt.month == now.month and dt.day == now.day:
-                weight *= 10
-                logger.info(f"Memory Bonus (10x) for {file} (Date: {dt.date()})")
+            if process_file(entry['path'], photo_id, entry, cached, pipe, scan):
+                changed.append((entry, photo_id))
         except Exception as e:
-            logger.debug(f"Weight calculation failed for {file}: {e}")
-            pass
-
-    if is_fav: weight *= 5
-    weight = max(1, weight)
-
-    # 4. Store in Redis
-    r.hset(f"photo:{file}", mapping={
-        "path": file,
-        "weight": weight,
-        "timestamp": timestamp,
-        "gps": gps,
-        "file_id": file_id or "",
-        "etag": etag or "",
-        "size": size
-    })
-    r.zadd("photo_pool", {f"photo:{file}": weight})
-    r.incr("stats:last_scan_processed")
-    logger.info(f"Processed {file}: Weight={weight}, Cached={bool(cached)}")
-
-def scan_recursive(path, executor):
+            logger.error(f"Error processing {entry['path']}: {e}")
+    pipe.execute()
+
+    # After the write, so hashes can be added to the new records
+    if changed:
+        finish_changed(changed)
+
+def run_batch(path, entries, scan):
+    # Runs on the thread pool; nobody collects the future, so failures are recorded here
     try:
-        r.sadd("stats:scanned_paths", path)
-        items = client.list(path)
-        if not items: return
-
-        # Check if directory is ignored
-        for item in items[1:]:
-            fn = os.path.basename(item.rstrip('/'))
-            if fn == IGNORE_FILE:
-                logger.info(f"Ignoring {path}")
-                return
-
-        for item in items[1:]:
-            full_path = item if item.startswith('/') else os.path.join(path, item)
-            
-            if full_path.endswith('/'):
-                scan_recursive(full_path, executor)
-            else:
-                executor.submit(process_file, full_path)
-                
+        process_batch(entries, scan)
+    except Exception as e:
+        logger.error(f"Error processing files in {path}: {e}")
+        scan.failed.add(path)
+
+def discard_failed(scan):
+    # A directory with a failed file batch is handled like a listing error: its photos
+    # are kept as they were and neither it nor its ancestors get their etag recorded,
+    # so the next scan lists it again. Returns False if any batch failed.
+    for path in scan.failed:
+        keep_subtree(path, scan.generation)
+        prefix = path.rstrip('/') + '/'
+        for recorded in list(scan.dir_records):
+            if prefix.startswith(recorded.rstrip('/') + '/'):
+                del scan.dir_records[recorded]
+    return not scan.failed
+
+def mark_subtree_live(path, generation):
+    # Nextcloud propagates etag changes up the tree, so an unchanged directory etag
+    # means nothing below it changed. Re-add its photos to the pool from Redis alone
+    # and stamp them with the current generation so the sweep keeps them.
+    # Works level by level, with pipelines of at most SWEEP_BATCH directories or photos
+    # (like sweep), so a large unchanged tree never becomes one huge pipeline.
+    found = 0
+    level = [path]
+    while level:
+        subdirs = []
+        for start in range(0, len(level), SWEEP_BATCH):
+            dirs = level[start:start + SWEEP_BATCH]
+            pipe = r.pipeline(transaction=False)
+            for current in dirs:
+                pipe.smembers(f"dir_files:{current}")
+                pipe.smembers(f"dir_subdirs:{current}")
+            members = pipe.execute()
+            files = [photo_id for found_files in members[0::2] for photo_id in found_files]
+            subdirs.extend(sub for found_dirs in members[1::2] for sub in found_dirs)
+
+            pipe = r.pipeline(transaction=False)
+            pipe.sadd("stats:scanned_paths", *photos.dir_ids(r, dirs, create=True))
+            for current in dirs:
+                pipe.hset(f"dir:{current}", "gen", generation)
+            pipe.execute()
+
+            for file_start in range(0, len(files), SWEEP_BATCH):
+                batch = files[file_start:file_start + SWEEP_BATCH]
+                pipe = r.pipeline(transaction=False)
+                for photo_id, record in zip(batch, photos.get(r, batch)):
+                    if record:
+                        pipe.zadd("photo_pool", {photo_id: record['epoch']})
+                        record['gen'] = generation
+                        photos.put(pipe, photo_id, record)
+                pipe.execute()
+            found += len(files)
+        level = subdirs
+    return found
+
+def keep_subtree(path, generation):
+    # After an error: keep what we knew about this subtree instead of sweeping it
+    try:
+        mark_subtree_live(path, generation)
+    except Exception as e:
+        logger.error(f"Error keeping {path} alive: {e}")
+
+def unchanged(path, scan, etag, known_etag):
+    # A directory etag equal to the one recorded by the previous scan means nothing
+    # below it changed: its photos are kept from Redis without listing it
+    if etag and known_etag == etag:
+        scan.stats.incr("found", mark_subtree_live(path, scan.generation))
+        return True
+    return False
+
+# What a scan engine does next with a listed directory: walk subdirs ((entry, recorded
+# etag) pairs), process the file batches and, once all of that succeeded, record its
+# etag (record, None without an etag). ignored is set for directories with IGNORE_FILE.
+Visit = namedtuple('Visit', ['subdirs', 'batches', 'record', 'ignored'])
+
+def visit_directory(path, scan, etag, directory, children):
+    # The per-directory steps shared by all scan engines, after listing path.
+    # etag is None for the root (then taken from the listing). Returns None when the
+    # directory turns out to be unchanged, so there is nothing left to do.
+    if etag is None and directory:
+        etag = directory['etag']
+        if etag and unchanged(path, scan, etag, r.hget(f"dir:{path}", "etag")):
+            return None
+    r.sadd("stats:scanned_paths", *photos.dir_ids(r, [path], create=True))
+
+    for entry in children:
+        if os.path.basename(entry['path'].rstrip('/')) == IGNORE_FILE:
+            logger.info(f"Ignoring {path}")
+            return Visit([], [], (etag, [], []) if etag else None, True)
+
+    subdirs = [entry for entry in children if entry['is_dir']]
+    files = [entry for entry in children if not entry['is_dir']]
+    pipe = r.pipeline(transaction=False)
+    for entry in subdirs:
+        pipe.hget(f"dir:{entry['path']}", "etag")
+    known_etags = pipe.execute() if subdirs else []
+
+    batches = [files[start:start + FILE_BATCH] for start in range(0, len(files), FILE_BATCH)]
+    record = None
+    if etag:
+        photo_paths = [e['path'] for e in files if e['path'].lower().endswith(PHOTO_EXTENSIONS)]
+        record = (etag, photo_paths, [e['path'] for e in subdirs])
+    return Visit(list(zip(subdirs, known_etags)), batches, record, False)
+
+def scan_recursive(path, scan, etag=None, known_etag=None):
+    # Returns True when the whole subtree was listed successfully; only then is
+    # its directory etag recorded in scan.dir_records for pruning on the next scan.
+    # known_etag is the etag stored by the previous scan (looked up by the parent).
+    try:
+        if unchanged(path, scan, etag, known_etag):
+            return True
+        visit = visit_directory(path, scan, etag, *list_directory(path))
+        if visit is None:
+            return True
+        if visit.ignored:
+            scan.ignored.add(path)
+
+        for batch in visit.batches:
+            scan.executor.submit(run_batch, path, batch, scan)
+        ok = True
+        for entry, known in visit.subdirs:
+            ok = scan_recursive(entry['path'], scan, entry['etag'], known) and ok
+
+        if ok and visit.record:
+            scan.dir_records[path] = visit.record
+        return ok
+
     except Exception as e:
         logger.error(f"Error scanning {path}: {e}")
+        keep_subtree(path, scan.generation)
+        return False
+
+def list_favorites(path):
+    # Paths of all favorite files below path, from one oc:filter-files REPORT
+    url = NC_URL + '/' + path.lstrip('/')
+    resp = limiter.request(nc_limiter, session, "REPORT", url, data=FAVORITES_BODY)
+    resp.raise_for_status()
+    prefix = path.rstrip('/') + '/'
+    return {entry['path'] for entry in parse_propfind(resp.content)
+            if not entry['is_dir'] and entry['path'].startswith(prefix)}
+
+def refresh_favorites(path):
+    # Bring the stored favorite flags in line with Nextcloud, including photos in
+    # subtrees the scan pruned. Returns the number of photos whose flag changed.
+    try:
+        favorites = set(photos.find(r, sorted(list_favorites(path))))
+    except Exception as e:
+        logger.warning(f"Could not list favorites, flags of unchanged folders may be stale: {e}")
+        return 0
+    changed = 0
+    total = r.zcard("photo_pool")
+    for start in range(0, total, SWEEP_BATCH):
+        ids = r.zrange("photo_pool", start, start + SWEEP_BATCH - 1)
+        for photo_id, record in zip(ids, photos.get(r, ids)):
+            favorite = int(photo_id) in favorites
+            if record and record['favorite'] != favorite:
+                photos.update(r, photo_id, favorite=favorite)
+                changed += 1
+    return changed
+
+def save_dir_records(dir_records, generation, ignored=()):
+    # File lists hold photo ids; the photos of each directory were stored while it was walked
+    file_ids = {}
+    for path, (_, files, _) in dir_records.items():
+        if files:
+            file_ids[path] = [photo_id for photo_id in photos.find(r, files) if photo_id]
+
+    pipe = r.pipeline(transaction=False)
+    # Ignored directories are remembered for the sync mode (sync_collection.py)
+    if ignored:
+        pipe.sadd("scan:ignored", *ignored)
+    for path, (etag, files, subdirs) in dir_records.items():
+        if path not in ignored:
+            pipe.srem("scan:ignored", path)
+        pipe.hset(f"dir:{path}", mapping={"etag": etag, "gen": generation})
+        pipe.delete(f"dir_files:{path}", f"dir_subdirs:{path}")
+        if file_ids.get(path):
+            pipe.sadd(f"dir_files:{path}", *file_ids[path])
+        if subdirs:
+            pipe.sadd(f"dir_subdirs:{path}", *subdirs)
+    pipe.execute()
+
+def sweep(generation):
+    # Remove photos and directory records that were not seen in this scan generation
+    stale = []
+    total = r.zcard("photo_pool")
+    for start in range(0, total, SWEEP_BATCH):
+        ids = r.zrange("photo_pool", start, start + SWEEP_BATCH - 1)
+        for photo_id, record in zip(ids, photos.get(r, ids)):
+            if not record or record['gen'] != generation:
+                stale.append((photo_id, record))
+
+    for start in range(0, len(stale), SWEEP_BATCH):
+        pipe = r.pipeline(transaction=False)
+        for photo_id, record in stale[start:start + SWEEP_BATCH]:
+            if record:
+                photos.remove(pipe, photo_id, record)
+            else:
+                pipe.zrem("photo_pool", photo_id)
+        pipe.execute()
 
-def run_scan():
+    stale_dirs = []
+    for key in r.scan_iter(match="dir:*", count=SWEEP_BATCH):
+        stale_dirs.append(key)
+        if len(stale_dirs) >= SWEEP_BATCH:
+            _sweep_dirs(stale_dirs, generation)
+            stale_dirs = []
+    if stale_dirs:
+        _sweep_dirs(stale_dirs, generation)
+
+    return len(stale)
+
+def _sweep_dirs(keys, generation):
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.hget(key, "gen")
+    pipe_del = r.pipeline(transaction=False)
+    for key, gen in zip(keys, pipe.execute()):
+        if gen != str(generation):
+            path = key[len("dir:"):]
+            pipe_del.delete(key, f"dir_files:{path}", f"dir_subdirs:{path}")
+    pipe_del.execute()
+
+def run_scan(tick=None):
+    # tick: timestamp of the scheduled run, so replicas start each scheduled scan once
     photo_path = os.getenv('NC_PHOTO_PATH', '/Photos/')
+    if SCANNER_MODE == 'distributed':
+        import distributed_scanner
+        distributed_scanner.run(photo_path, tick)
+        return
+
     r.set("stats:last_scan_found", 0)
     r.set("stats:last_scan_processed", 0)
     r.delete("stats:scanned_paths")
+    # Every photo and directory seen by this scan is tagged with its generation id
+    generation = r.incr("scan:generation")
+
+    # Taken before the walk, so changes made during the scan are replayed by the sync mode
+    sync_token = None
+    if SYNC_INTERVAL:
+        import sync_collection
+        try:
+            sync_token = sync_collection.current_token(photo_path)
+        except Exception as e:
+            logger.warning(f"Could not read sync token, sync mode unavailable: {e}")
     
-    logger.info(f"Scanning {photo_path} with {MAX_WORKERS} threads...")
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        scan_recursive(photo_path, executor)
+    if SCANNER_MODE == 'async':
+        import async_scanner
+        logger.info(f"Scanning {photo_path} with asyncio, {async_scanner.CONCURRENCY} concurrent requests (generation {generation})...")
+        ok, scan = async_scanner.run(photo_path, generation)
+    else:
+        logger.info(f"Scanning {photo_path} with {MAX_WORKERS} threads (generation {generation})...")
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            scan = Scan(generation, executor)
+            ok = scan_recursive(photo_path, scan)
+    # All file batches have finished here
+    ok = discard_failed(scan) and ok
+    scan.stats.flush()
+
+    # Directory etags are only stored once every file below them has been processed,
+    # so an interrupted scan never causes a subtree to be skipped next time.
+    save_dir_records(scan.dir_records, generation, scan.ignored)
+    logger.info(f"Recorded etags for {len(scan.dir_records)} directories")
+
+    favorites = refresh_favorites(photo_path)
+    if favorites:
+        logger.info(f"Updated the favorite flag of {favorites} photos")
+
+    if ok:
+        removed = sweep(generation)
+        r.set("stats:last_scan_removed", removed)
+        logger.info(f"Removed {removed} stale photos")
+    else:
+        logger.warning("Scan had errors, skipping removal of stale photos")
+    if ok and sync_token:
+        r.set("sync:token", sync_token)
+
+    count, total = selection.rebuild_index(r)
+    duplicates = r.get("select:duplicates") or 0
+    logger.info(f"Selection index rebuilt: {count} photos, {duplicates} near-duplicates collapsed, total weight {total:.0f}")
+
+def render_worker():
+    # Renders the photos the app queued for upcoming slides (see prefetch queue in app.py)
+    while True:
+        try:
+            item = r.blpop("render:queue", timeout=30)
+            if not item:
+                continue
+            record = photos.get(r, [item[1]])[0]
+            if record and record['etag']:
+                path, etag, file_id = record['path'], record['etag'], record.get('file_id')
+                rendition = renditions.get_rendition(path, etag, file_id=file_id)
+                renditions.get_background(path, etag, file_id)
+                # Photos the scanner could not hash (no thumbnail, no preview)
+                if not record.get('phash') and selection.DUPLICATE_DISTANCE > 0:
+                    phash = photo_metadata.image_hash(rendition.path)
+                    if phash:
+                        photos.update(r, item[1], phash=phash)
+        except Exception as e:
+            logger.error(f"Render worker error: {e}")
+            time.sleep(5)
 
 if __name__ == "__main__":
+    # async_scanner and distributed_scanner import this module by name; share it instead of loading a second copy
+    sys.modules.setdefault('scanner', sys.modules[__name__])
+
     cron_schedule = os.getenv('SCAN_CRON', '0 1 * * *') # Default daily at 1 AM
     logger.info(f"Scanner started. Schedule: {cron_schedule}")
 
+    for _ in range(RENDER_WORKERS):
+        threading.Thread(target=render_worker, daemon=True).start()
+    if weather.enabled():
+        threading.Thread(target=weather.refresher, args=(r,), daemon=True).start()
+    # Place names are downloaded once into the data volume, never at image build time
+    threading.Thread(target=geocoder.ensure_index, daemon=True).start()
+
+    # Photo records of older versions are converted once before anything else runs
+    migrated = photos.migrate(r)
+    if migrated:
+        logger.info(f"Migrated {migrated} photos to the compact record format")
+
     # Run immediately on startup
     logger.info("Starting initial scan...")
     r.set("scanner:status", "running")
@@ -228,12 +687,17 @@ if __name__ == "__main__":
             delay = (next_run - now).total_seconds()
             
             logger.info(f"Next scan scheduled for {next_run} (in {int(delay)} seconds)")
-            if delay > 0:
+            if SYNC_INTERVAL and r.get("sync:token"):
+                # Apply changes as they happen; returns early if a full scan is needed
+                import sync_collection
+                sync_collection.follow(os.getenv('NC_PHOTO_PATH', '/Photos/'), next_run)
+            elif delay > 0:
                 time.sleep(delay)
             
             logger.info("Starting scheduled scan...")
             r.set("scanner:status", "running")
-            run_scan()
+            # Early scans requested by the sync mode are not the scheduled one
+            run_scan(int(next_run.timestamp()) if datetime.now() >= next_run else None)
             r.set("scanner:status", "idle")
             r.set("stats:last_scan_time", datetime.now().isoformat())
         except Exception as e:
@@ -0,0 +1,459 @@
+import os
+import time
+import random
+import calendar
+from collections import deque
+from datetime import datetime, timezone
+import photo_metadata
+import photos
+
+# Weighted photo selection.
+#
+# The scanner only stores raw attributes (capture date, favorite flag). Weights are
+# derived from them by a weighting policy when the selection index is rebuilt, and
+# the time-dependent part ("on this day" bonus) is applied at pick time, so the
+# weighting stays correct without rescanning.
+#
+# Index layout (rebuilt after every scan by rebuild_index; between scans the sync
+# mode appends new photos with add_to_index and drops deleted ones):
+#   select:cdf           zset  photo id -> cumulative weight (prefix sum over all photos)
+#   select:total         total weight of select:cdf
+#   select:day:<MMDD>    zset  same, restricted to photos taken on that month/day
+#   select:day_totals    hash  MMDD -> total weight of select:day:<MMDD>
+#   select:aspect:<class>:*   the same four keys per aspect class (landscape, portrait,
+#                             square, panorama), for displays that only show one shape
+#   select:weight        hash  photo id -> weight (the width of its step in every cdf)
+#
+# Bursts and near-identical edits are collapsed: only one representative per
+# cluster of near-duplicates is indexed, carrying the weight of its best member.
+# Members point to it with the "cluster" field of their photo record.
+# A pick draws u in [0, total) and takes the first member whose cumulative score
+# exceeds u: one ZRANGEBYSCORE, O(log n).
+#
+# Excluded photos (recently shown) are removed without retrying: each one owns the
+# interval (score - weight, score] of the cdf, u is drawn from the total minus those
+# intervals and then shifted past every interval that starts at or before it.
+
+BATCH_SIZE = 1000
+
+# Aspect classes, by displayed width / height
+ASPECTS = ('landscape', 'portrait', 'square', 'panorama')
+PANORAMA_RATIO = 2.0
+SQUARE_TOLERANCE = 1.1
+
+# Near-duplicates: perceptual hashes at most this many bits apart (0 disables),
+# taken within DUPLICATE_WINDOW seconds of each other (or both with unknown dates)
+DUPLICATE_DISTANCE = int(os.getenv('DUPLICATE_DISTANCE', '4'))
+DUPLICATE_WINDOW = 3600
+
+
+def capture_epoch(timestamp):
+    # EXIF timestamps carry no timezone; treat them as UTC so the month/day is stable
+    if not timestamp or timestamp == 'Unknown':
+        return 0
+    try:
+        dt = datetime.strptime(timestamp, "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return 0
+    return calendar.timegm(dt.timetuple())
+
+
+def day_of_year_key(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%m%d")
+
+
+class RecencyPolicy:
+    """Newer photos are much more likely, favorites 5x, 10x on the anniversary of the capture date."""
+    name = 'recency'
+    day_bonus = 10
+
+    def base_weight(self, epoch, favorite, now):
+        weight = 10.0
+        if epoch:
+            # Exponential decay is shift-invariant: the relative weights computed here
+            # stay correct as time passes, only the absolute scale changes.
+            age_years = (now - epoch) / (365.0 * 86400)
+            weight = max(1.0, 100 * (0.85 ** max(0, age_years)))
+        if favorite:
+            weight *= 5
+        return weight
+
+
+class UniformPolicy:
+    """Every photo is equally likely."""
+    name = 'uniform'
+    day_bonus = 1
+
+    def base_weight(self, epoch, favorite, now):
+        return 1.0
+
+
+class FavoritesPolicy:
+    """Ignore age, strongly prefer favorites and keep the anniversary bonus."""
+    name = 'favorites'
+    day_bonus = 10
+
+    def base_weight(self, epoch, favorite, now):
+        return 20.0 if favorite else 1.0
+
+
+POLICIES = {}
+
+
+def register_policy(policy):
+    POLICIES[policy.name] = policy
+
+
+for _policy in (RecencyPolicy(), UniformPolicy(), FavoritesPolicy()):
+    register_policy(_policy)
+
+
+def get_policy():
+    return POLICIES.get(os.getenv('WEIGHT_POLICY', 'recency'), POLICIES['recency'])
+
+
+def aspect_class(width, height, orientation=None):
+    # Shape of the photo as displayed; None when the dimensions are unknown
+    try:
+        width, height = photo_metadata.display_size(int(width), int(height), int(orientation or 1))
+    except (TypeError, ValueError):
+        return None
+    if not width or not height:
+        return None
+    ratio = width / height
+    if ratio >= PANORAMA_RATIO:
+        return 'panorama'
+    if ratio > SQUARE_TOLERANCE:
+        return 'landscape'
+    if ratio >= 1 / SQUARE_TOLERANCE:
+        return 'square'
+    return 'portrait'
+
+
+def index_prefix(aspect=None):
+    # Key prefix of the global index (None) or of one aspect pool
+    return f"select:aspect:{aspect}" if aspect else "select"
+
+
+def _write_cdf(pipe, key, items):
+    total = 0.0
+    batch = {}
+    for member, weight in items:
+        total += weight
+        batch[member] = total
+        if len(batch) >= BATCH_SIZE:
+            pipe.zadd(key, batch)
+            batch = {}
+    if batch:
+        pipe.zadd(key, batch)
+    return total
+
+
+def _stage(pipe, prefix, weights, by_day):
+    # Write one index into temporary :new keys
+    pipe.delete(f"{prefix}:cdf:new", f"{prefix}:day_totals:new")
+    total = _write_cdf(pipe, f"{prefix}:cdf:new", weights)
+    day_totals = {}
+    for day, items in by_day.items():
+        pipe.delete(f"{prefix}:day:{day}:new")
+        day_totals[day] = _write_cdf(pipe, f"{prefix}:day:{day}:new", items)
+    if day_totals:
+        pipe.hset(f"{prefix}:day_totals:new", mapping=day_totals)
+    return total
+
+
+def _swap(pipe, prefix, weights, by_day, old_days, total):
+    if weights:
+        pipe.rename(f"{prefix}:cdf:new", f"{prefix}:cdf")
+    else:
+        pipe.delete(f"{prefix}:cdf")
+    for day in by_day:
+        pipe.rename(f"{prefix}:day:{day}:new", f"{prefix}:day:{day}")
+    for day in old_days:
+        if day not in by_day:
+            pipe.delete(f"{prefix}:day:{day}")
+    if by_day:
+        pipe.rename(f"{prefix}:day_totals:new", f"{prefix}:day_totals")
+    else:
+        pipe.delete(f"{prefix}:day_totals")
+    pipe.set(f"{prefix}:total", total)
+
+
+def find_duplicates(photos, distance=DUPLICATE_DISTANCE, window=DUPLICATE_WINDOW):
+    # photos: list of (phash as int or None, epoch). Returns a cluster root index per photo.
+    #
+    # Photos are visited in capture order and only compared with the ones taken at
+    # most `window` seconds before (photos without a date only with each other), so
+    # the work grows with the size of a burst, not of the library. Within the window,
+    # multi-index hashing finds the candidates: the 64-bit hash is cut into
+    # distance + 1 chunks, two hashes at most `distance` bits apart agree on at least
+    # one whole chunk, and only photos sharing a chunk value are compared.
+    parent = list(range(len(photos)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if distance <= 0:
+        return parent
+    chunks = distance + 1
+    bounds = [64 * c // chunks for c in range(chunks + 1)]
+
+    def chunk_keys(phash):
+        return [(c, (phash >> bounds[c]) & ((1 << (bounds[c + 1] - bounds[c])) - 1)) for c in range(chunks)]
+
+    hashed = [i for i, (phash, _) in enumerate(photos) if phash is not None]
+    undated = [i for i in hashed if not photos[i][1]]
+    dated = sorted((i for i in hashed if photos[i][1]), key=lambda i: photos[i][1])
+    for group, limit in ((undated, None), (dated, window)):
+        buckets = {}
+        active = deque()
+        for i in group:
+            phash, epoch = photos[i]
+            # Drop photos that fell out of the window; buckets are in capture order,
+            # so the oldest active photo is at the front of each of its buckets
+            while limit is not None and active and epoch - photos[active[0]][1] > limit:
+                for key in chunk_keys(photos[active.popleft()][0]):
+                    bucket = buckets[key]
+                    bucket.popleft()
+                    if not bucket:
+                        del buckets[key]
+            candidates = set()
+            for key in chunk_keys(phash):
+                bucket = buckets.setdefault(key, deque())
+                candidates.update(bucket)
+                bucket.append(i)
+            active.append(i)
+            for j in candidates:
+                if bin(phash ^ photos[j][0]).count('1') <= distance:
+                    parent[root(i)] = root(j)
+    return [root(i) for i in range(len(photos))]
+
+
+def _phash(value):
+    # A zero hash comes from flat images (e.g. all black) and says nothing about similarity
+    try:
+        return int(value, 16) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def rebuild_index(r, policy=None):
+    policy = policy or get_policy()
+    now = time.time()
+
+    # photo_pool is scored by capture time; the other attributes live in the photo record
+    pool = r.zrange("photo_pool", 0, -1, withscores=True)
+    records = []
+    for start in range(0, len(pool), BATCH_SIZE):
+        chunk = pool[start:start + BATCH_SIZE]
+        for (photo_id, epoch), record in zip(chunk, photos.get(r, [photo_id for photo_id, _ in chunk])):
+            if record:
+                records.append((photo_id, int(epoch), record))
+
+    # Collapse near-duplicates into their best member (favorite first, then largest)
+    roots = find_duplicates([(_phash(record.get('phash')), epoch) for _, epoch, record in records])
+    clusters = {}
+    for i, root in enumerate(roots):
+        clusters.setdefault(root, []).append(i)
+
+    def rank(i):
+        photo_id, epoch, record = records[i]
+        pixels = record.get('width', 0) * record.get('height', 0)
+        return (record['favorite'], pixels, -epoch, int(photo_id))
+
+    # One index over all photos plus one per aspect class; photos with unknown
+    # dimensions are only in the global one.
+    pools = {aspect: ([], {}) for aspect in (None,) + ASPECTS}
+    duplicates = 0
+    for members in clusters.values():
+        best = max(members, key=rank)
+        key, epoch, record = records[best]
+        weight = max(policy.base_weight(records[i][1], records[i][2]['favorite'], now) for i in members)
+        aspect = aspect_class(record.get('width'), record.get('height'), record.get('orientation'))
+        for pool in {None, aspect}:
+            weights, by_day = pools[pool]
+            weights.append((key, weight))
+            if epoch:
+                by_day.setdefault(day_of_year_key(epoch), []).append((key, weight))
+
+        duplicates += len(members) - 1
+        # The records were read before clustering and the scanner may have written them
+        # since, so only the cluster field is changed (photos.update rereads the record)
+        for i in members:
+            member, _, member_record = records[i]
+            stored = member_record.get('cluster')
+            if len(members) > 1 and stored != key:
+                photos.update(r, member, cluster=key)
+            elif len(members) == 1 and stored:
+                photos.update(r, member, cluster=None)
+
+    pipe = r.pipeline(transaction=False)
+    for aspect in pools:
+        pipe.hkeys(f"{index_prefix(aspect)}:day_totals")
+    old_days = dict(zip(pools, pipe.execute()))
+
+    # Build into temporary keys and swap them in atomically
+    weights = pools[None][0]
+    pipe = r.pipeline(transaction=False)
+    totals = {aspect: _stage(pipe, index_prefix(aspect), *pools[aspect]) for aspect in pools}
+    pipe.delete("select:weight:new")
+    for start in range(0, len(weights), BATCH_SIZE):
+        pipe.hset("select:weight:new", mapping=dict(weights[start:start + BATCH_SIZE]))
+    pipe.execute()
+
+    pipe = r.pipeline(transaction=True)
+    for aspect, (weights, by_day) in pools.items():
+        _swap(pipe, index_prefix(aspect), weights, by_day, old_days[aspect], totals[aspect])
+    if pools[None][0]:
+        pipe.rename("select:weight:new", "select:weight")
+    else:
+        pipe.delete("select:weight")
+    pipe.set("select:duplicates", duplicates)
+    pipe.execute()
+    return len(pools[None][0]), totals[None]
+
+
+# Append one photo to the end of an index: its step starts at the current total.
+# KEYS: cdf, total, day cdf, day totals; ARGV: photo id, weight, MMDD ('' if undated)
+APPEND = """
+local total = tonumber(redis.call('GET', KEYS[2]) or '0') + tonumber(ARGV[2])
+redis.call('ZADD', KEYS[1], total, ARGV[1])
+redis.call('SET', KEYS[2], total)
+if ARGV[3] ~= '' then
+    redis.call('ZADD', KEYS[3], redis.call('HINCRBYFLOAT', KEYS[4], ARGV[3], ARGV[2]), ARGV[1])
+end
+"""
+
+
+def add_to_index(r, ids, policy=None):
+    # Incremental update between full rebuilds (sync mode): photos that are not in the
+    # index yet are appended to every cdf they belong to. Near-duplicates and weights of
+    # photos that changed are only updated by the next rebuild_index.
+    policy = policy or get_policy()
+    ids = list(dict.fromkeys(str(photo_id) for photo_id in ids))
+    if not ids or not r.exists("select:total"):
+        # No index yet: the scan in progress builds it
+        return 0
+    new = [photo_id for photo_id, weight in zip(ids, r.hmget("select:weight", ids)) if weight is None]
+    now = time.time()
+    pipe = r.pipeline(transaction=False)
+    added = 0
+    for photo_id, record in zip(new, photos.get(r, new)):
+        if not record or record.get('cluster'):
+            continue
+        weight = policy.base_weight(record['epoch'], record['favorite'], now)
+        day = day_of_year_key(record['epoch']) if record['epoch'] else ''
+        aspect = aspect_class(record.get('width'), record.get('height'), record.get('orientation'))
+        for pool in {None, aspect}:
+            prefix = index_prefix(pool)
+            pipe.eval(APPEND, 4, f"{prefix}:cdf", f"{prefix}:total", f"{prefix}:day:{day}",
+                      f"{prefix}:day_totals", photo_id, weight, day)
+        pipe.hset("select:weight", photo_id, weight)
+        added += 1
+    pipe.execute()
+    return added
+
+
+def remove_from_index(r, removed):
+    # removed: (photo id, record) of deleted photos. They leave every index right away;
+    # until the next rebuild_index the photo after each one also gets its share.
+    pipe = r.pipeline(transaction=False)
+    for photo_id, record in removed:
+        day = day_of_year_key(record['epoch']) if record['epoch'] else None
+        for pool in (None,) + ASPECTS:
+            prefix = index_prefix(pool)
+            pipe.zrem(f"{prefix}:cdf", photo_id)
+            if day:
+                pipe.zrem(f"{prefix}:day:{day}", photo_id)
+        pipe.hdel("select:weight", photo_id)
+    pipe.execute()
+
+
+def _excluded_intervals(ends, weights):
+    # Sorted (start, width) cdf intervals of the excluded photos present in one index
+    intervals = sorted((end - weight, weight) for end, weight in zip(ends, weights) if end is not None and weight)
+    return intervals, sum(width for _, width in intervals)
+
+
+def _skip(u, intervals):
+    # Map u from the reduced range onto the cdf, jumping over the excluded intervals
+    for start, width in intervals:
+        if start > u:
+            break
+        u += width
+    return u
+
+
+def pick(r, count=1, now=None, policy=None, aspects=None, exclude=None):
+    # aspects: aspect classes to draw from (e.g. ['portrait']), None for all photos
+    # exclude: photo ids that must not be picked (e.g. recently shown)
+    policy = policy or get_policy()
+    today = (now or datetime.now()).strftime("%m%d")
+    exclude = list(dict.fromkeys(exclude or []))
+
+    pools = list(aspects or []) or [None]
+    pipe = r.pipeline(transaction=False)
+    for aspect in pools:
+        pipe.get(f"{index_prefix(aspect)}:total")
+        pipe.hget(f"{index_prefix(aspect)}:day_totals", today)
+    if exclude:
+        pipe.hmget("select:weight", exclude)
+        for aspect in pools:
+            pipe.zmscore(f"{index_prefix(aspect)}:cdf", exclude)
+            pipe.zmscore(f"{index_prefix(aspect)}:day:{today}", exclude)
+    results = pipe.execute()
+    sums, results = results[:2 * len(pools)], results[2 * len(pools):]
+    weights = [float(w) if w else 0.0 for w in results[0]] if exclude else []
+
+    # Photos taken on this day are boosted by day_bonus: their extra mass is
+    # (day_bonus - 1) * day_total, drawn from the per-day index.
+    segments = []
+    for i, aspect in enumerate(pools):
+        total, day_total = float(sums[2 * i] or 0), float(sums[2 * i + 1] or 0)
+        if total <= 0:
+            continue
+        skip, day_skip = ([], 0.0), ([], 0.0)
+        if exclude:
+            skip = _excluded_intervals(results[1 + 2 * i], weights)
+            day_skip = _excluded_intervals(results[2 + 2 * i], weights)
+        base = total - skip[1]
+        extra = (policy.day_bonus - 1) * (day_total - day_skip[1])
+        if base > 1e-9:
+            segments.append((index_prefix(aspect), base, extra, skip[0], day_skip[0]))
+    if not segments:
+        if exclude and any(float(t or 0) > 0 for t in sums[::2]):
+            # Everything matching was excluded (small library): allow repeats
+            return pick(r, count, now, policy, aspects)
+        if aspects:
+            # No photo of the requested shape (or dimensions not scanned yet)
+            return pick(r, count, now, policy, exclude=exclude)
+        # Index not built yet (first scan still running): uniform fallback
+        return r.zrandmember("photo_pool", count) or []
+
+    # Several pools are sampled as one: choose a pool by its mass, then search inside it
+    mass = sum(base + extra for _, base, extra, _, _ in segments)
+    pipe = r.pipeline(transaction=False)
+    for _ in range(count):
+        u = random.random() * mass
+        for prefix, base, extra, skip, day_skip in segments:
+            if u < base + extra:
+                break
+            u -= base + extra
+        if u < base:
+            u = _skip(u, skip)
+            pipe.zrangebyscore(f"{prefix}:cdf", f"({u}", "+inf", start=0, num=1)
+        else:
+            v = _skip((u - base) / (policy.day_bonus - 1), day_skip)
+            pipe.zrangebyscore(f"{prefix}:day:{today}", f"({v}", "+inf", start=0, num=1)
+
+    # Draws within one call are independent, so drop repeats (and float edge cases)
+    excluded = set(exclude)
+    picked = []
+    for found in pipe.execute():
+        if found and found[0] not in excluded:
+            excluded.add(found[0])
+            picked.append(found[0])
+    return picked
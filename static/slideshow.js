@@ -0,0 +1,123 @@
+function updateTime() {
+    const now = new Date();
+    const hours = String(now.getHours()).padStart(2, '0');
+    const minutes = String(now.getMinutes()).padStart(2, '0');
+    document.getElementById('clock').textContent = hours + ':' + minutes;
+}
+updateTime();
+setInterval(updateTime, 1000);
+
+// Settings rendered into the page (see templates/index.html)
+const config = document.body.dataset;
+const reloadInterval = Number(config.reloadInterval) * 1000;
+const quietTime = config.quietTime;
+const version = config.version;
+
+function isQuietTime() {
+    if (!quietTime) return false;
+
+    const now = new Date();
+    const currentTime = now.getHours() * 60 + now.getMinutes();
+
+    const ranges = quietTime.split(',');
+
+    for (const range of ranges) {
+        const parts = range.trim().split('-');
+        if (parts.length !== 2) continue;
+
+        const [startH, startM] = parts[0].split(':').map(Number);
+        const [endH, endM] = parts[1].split(':').map(Number);
+
+        const start = startH * 60 + startM;
+        const end = endH * 60 + endM;
+
+        if (start <= end) {
+            if (currentTime >= start && currentTime < end) return true;
+        } else {
+            // Overnight range (e.g. 22:00-06:00)
+            if (currentTime >= start || currentTime < end) return true;
+        }
+    }
+    return false;
+}
+
+function preload(url) {
+    return new Promise((resolve, reject) => {
+        const img = new Image();
+        img.onload = () => resolve(img);
+        img.onerror = reject;
+        img.src = url;
+    });
+}
+
+function setText(id, text) {
+    document.getElementById(id).textContent = text;
+}
+
+function setVisible(id, visible) {
+    document.getElementById(id).classList.toggle('hidden', !visible);
+}
+
+function updateOverlay(slide) {
+    setText('month', slide.month);
+    setText('year', slide.year);
+    setText('location', slide.location);
+    setText('total-photos', slide.total_photos);
+    setText('last-scan', slide.last_scan);
+    setVisible('status-indexing', slide.scanner_status === 'running');
+    setVisible('status-last-scan', slide.scanner_status !== 'running' && !!slide.last_scan);
+
+    setVisible('weather', !!slide.weather);
+    if (slide.weather) {
+        setText('weather-current', slide.weather.current.icon + ' ' + slide.weather.current.temp + '°C');
+        setText('weather-tomorrow', slide.weather.tomorrow.icon + ' ' + slide.weather.tomorrow.min + '° / ' + slide.weather.tomorrow.max + '°');
+    }
+
+    setVisible('qr', !!slide.qr);
+    if (slide.qr) {
+        document.getElementById('qr-link').href = slide.qr.link;
+        document.getElementById('qr-img').src = slide.qr.image;
+    }
+}
+
+async function showNext() {
+    // Same ?display= and ?aspect= as the page
+    const url = '/api/next' + window.location.search;
+    const resp = await fetch(url, { cache: 'no-store' });
+    if (!resp.ok) throw new Error('HTTP ' + resp.status);
+    const slide = await resp.json();
+
+    // A new release may change the page itself
+    if (slide.version !== version) {
+        window.location.reload();
+        return;
+    }
+
+    // Swap only once the new photo is fully loaded, then crossfade
+    await Promise.all([preload(slide.photo.image), preload(slide.photo.background)]);
+    const current = document.querySelector('.slide.visible');
+    const upcoming = document.querySelector('.slide:not(.visible)');
+    upcoming.querySelector('.background').style.backgroundImage = "url('" + slide.photo.background + "')";
+    upcoming.querySelector('.photo').src = slide.photo.image;
+    upcoming.classList.add('visible');
+    current.classList.remove('visible');
+    updateOverlay(slide);
+
+    if (slide.next) {
+        preload(slide.next.image).catch(() => {});
+        preload(slide.next.background).catch(() => {});
+    }
+}
+
+function tick() {
+    if (isQuietTime()) {
+        // Check again after interval
+        setTimeout(tick, reloadInterval);
+        return;
+    }
+    showNext()
+        .catch((e) => console.error('Slideshow error:', e))
+        .finally(() => setTimeout(tick, reloadInterval));
+}
+
+setTimeout(tick, reloadInterval);
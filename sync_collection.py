@@ -0,0 +1,203 @@
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+import scanner
+import photos
+import selection
+import limiter
+from scanner import logger, r
+
+# Incremental indexing with the WebDAV sync-collection REPORT (RFC 6578).
+#
+# Every full scan records the collection's sync token (taken before the walk, so
+# nothing that changes during the scan is missed). Between scans the worker asks
+# the server every SYNC_INTERVAL seconds for what changed since that token and
+# applies only those entries: new and modified photos are read like in a scan,
+# deleted ones are removed. The cron scan stays as a periodic consistency check.
+
+TOKEN_KEY = "sync:token"
+# Every worker replica follows the changes; one at a time applies them
+LOCK_KEY = "sync:lock"
+LOCK_SECONDS = 600
+
+DAV_PROPS = (
+    '<d:prop>'
+    '<oc:favorite/><oc:fileid/><d:getetag/><d:getcontentlength/><d:resourcetype/>'
+    '</d:prop>'
+)
+TOKEN_BODY = (
+    '<?xml version="1.0"?>'
+    '<d:propfind xmlns:d="DAV:"><d:prop><d:sync-token/></d:prop></d:propfind>'
+)
+
+
+class TokenExpired(Exception):
+    pass
+
+
+def report_body(token):
+    return (
+        '<?xml version="1.0"?>'
+        '<d:sync-collection xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+        f'<d:sync-token>{token}</d:sync-token>'
+        '<d:sync-level>infinite</d:sync-level>'
+        f'{DAV_PROPS}'
+        '</d:sync-collection>'
+    )
+
+
+def collection_url(photo_path):
+    return scanner.NC_URL + '/' + photo_path.strip('/') + '/'
+
+
+def current_token(photo_path):
+    # The collection's DAV:sync-token property, None if the server does not support it
+    resp = limiter.request(scanner.nc_limiter, scanner.session, "PROPFIND", collection_url(photo_path),
+                           data=TOKEN_BODY, headers={'Depth': '0'})
+    resp.raise_for_status()
+    root = ET.fromstring(resp.content)
+    token = root.findtext('.//d:sync-token', default='', namespaces=scanner.DAV_NS)
+    return token or None
+
+
+def parse_changes(content):
+    # Returns (changed entries as in scanner.parse_propfind, deleted paths, new sync token)
+    root = ET.fromstring(content)
+    deleted = []
+    for response in root.findall('d:response', scanner.DAV_NS):
+        status = response.findtext('d:status', default='', namespaces=scanner.DAV_NS)
+        if ' 404 ' in status:
+            href = response.findtext('d:href', default='', namespaces=scanner.DAV_NS)
+            deleted.append(scanner.href_to_path(href))
+    token = root.findtext('d:sync-token', default='', namespaces=scanner.DAV_NS)
+    return scanner.parse_propfind(content), deleted, token or None
+
+
+def fetch_changes(photo_path, token):
+    resp = limiter.request(scanner.nc_limiter, scanner.session, "REPORT", collection_url(photo_path),
+                           data=report_body(token), headers={'Depth': '0'})
+    if resp.status_code in (403, 409):
+        # DAV:valid-sync-token precondition failed: token too old or unknown
+        raise TokenExpired()
+    if resp.status_code in (405, 501):
+        raise NotImplementedError("server does not support sync-collection")
+    resp.raise_for_status()
+    return parse_changes(resp.content)
+
+
+def glob_escape(text):
+    return re.sub(r'([*?\[\]\\])', r'\\\1', text)
+
+
+def remove_photos(paths):
+    # Deleted files, and everything below deleted folders (reported once per folder)
+    # Every scanned folder has a directory id, so a known id tells folders apart from
+    # files whatever their names look like (e.g. "2019.07 Rome")
+    files, dirs = [], []
+    for path, dir_id in zip(paths, photos.dir_ids(r, paths) if paths else []):
+        if dir_id is not None:
+            prefix = photos.normalize_dir(path)
+            dirs.append(prefix)
+            dirs.extend(d for d, _ in r.hscan_iter(photos.DIRS_KEY, match=f"{glob_escape(prefix)}/*"))
+        elif path.lower().endswith(scanner.PHOTO_EXTENSIONS):
+            files.append(path)
+
+    ids = [photo_id for photo_id in photos.find(r, files) if photo_id] if files else []
+    for dir_id in photos.dir_ids(r, dirs) if dirs else []:
+        if dir_id is not None:
+            ids.extend(r.hvals(photos.names_key(dir_id)))
+    # (photo id, record) of the removed photos
+    removed = []
+    for start in range(0, len(ids), scanner.SWEEP_BATCH):
+        batch = ids[start:start + scanner.SWEEP_BATCH]
+        pipe = r.pipeline(transaction=False)
+        for photo_id, record in zip(batch, photos.get(r, batch)):
+            if record:
+                photos.remove(pipe, photo_id, record)
+                removed.append((photo_id, record))
+        pipe.execute()
+    return removed
+
+
+def is_ignored(path, ignored):
+    return any(path.startswith(directory.rstrip('/') + '/') for directory in ignored)
+
+
+def sync_once(photo_path):
+    # Apply the changes since the stored token. Returns the number of photos added,
+    # updated or removed, or None if a full scan is needed instead.
+    # Replicas take turns, and skip while a distributed scan is still running, so two
+    # of them never store the same new file under two ids.
+    if scanner.SCANNER_MODE == 'distributed':
+        import distributed_scanner
+        if r.exists(distributed_scanner.RUN_KEY):
+            return 0
+    if not r.set(LOCK_KEY, 1, nx=True, ex=LOCK_SECONDS):
+        return 0
+    try:
+        return apply_changes(photo_path)
+    finally:
+        r.delete(LOCK_KEY)
+
+
+def apply_changes(photo_path):
+    token = r.get(TOKEN_KEY)
+    if not token:
+        return None
+    try:
+        changed, deleted, new_token = fetch_changes(photo_path, token)
+    except TokenExpired:
+        logger.warning("Sync token expired, a full scan is needed")
+        r.delete(TOKEN_KEY)
+        return None
+    except NotImplementedError as e:
+        # Without a token the worker goes back to cron scans only
+        logger.warning(f"Sync mode disabled: {e}")
+        r.delete(TOKEN_KEY)
+        scanner.SYNC_INTERVAL = 0
+        return None
+
+    if any(os.path.basename(path.rstrip('/')) == scanner.IGNORE_FILE for path in
+           [entry['path'] for entry in changed] + deleted):
+        # Folders were (un)ignored: the scan works out which photos that affects
+        logger.info("Ignore marker changed, a full scan is needed")
+        return None
+
+    ignored = r.smembers("scan:ignored")
+    files = [entry for entry in changed if not entry['is_dir'] and not is_ignored(entry['path'], ignored)]
+    # Tagged with the last scan's generation; the next scan walks their folders
+    # (the folder etags changed) and stamps them with its own
+    scan = scanner.Scan(int(r.get("scan:generation") or 0), None, stats_prefix="stats:sync_")
+    for start in range(0, len(files), scanner.FILE_BATCH):
+        scanner.process_batch(files[start:start + scanner.FILE_BATCH], scan)
+    removed = remove_photos(deleted)
+    scan.stats.incr("removed", len(removed))
+    scan.stats.flush()
+
+    processed = scan.stats.totals.get("processed", 0)
+    if processed or removed:
+        # Only the changed photos are touched; the next scan rebuilds the whole index
+        # (weights of updated photos, near-duplicates)
+        added = selection.add_to_index(r, [photo_id for photo_id in photos.find(r, [e['path'] for e in files]) if photo_id])
+        selection.remove_from_index(r, removed)
+        logger.info(f"Sync: {processed} photos added or updated ({added} new in the index), {len(removed)} removed")
+    if new_token:
+        r.set(TOKEN_KEY, new_token)
+    return processed + len(removed)
+
+
+def follow(photo_path, until):
+    # Poll for changes until the given datetime (the next full scan).
+    # Returns early when a full scan is needed.
+    while True:
+        remaining = (until - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return
+        time.sleep(min(scanner.SYNC_INTERVAL, remaining))
+        try:
+            if sync_once(photo_path) is None:
+                return
+        except Exception as e:
+            logger.error(f"Sync error: {e}")
@@ -0,0 +1,110 @@
+import io
+import os
+import sys
+import time
+import tempfile
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image
+
+# Render time and bytes transferred for RENDITION_SOURCE=preview vs original, against a
+# local stand-in for Nextcloud (WebDAV GET of the original, /index.php/core/preview).
+#
+#     python tests/bench_renditions.py [runs] [megapixels]
+#
+# The stand-in keeps its previews like Nextcloud does, so they are made once up front.
+# Numbers are per uncached display rendition (RENDITION_SIZE, default 1920x1080).
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+MEGAPIXELS = float(sys.argv[2]) if len(sys.argv) > 2 else 24
+
+
+def make_original(megapixels):
+    # Noisy photo-like content, so the JPEG is about as large as a real camera file
+    width = int((megapixels * 1e6 * 3 / 2) ** 0.5)
+    height = width * 2 // 3
+    noise = Image.effect_noise((width, height), 64)
+    image = Image.merge('RGB', (noise, noise.rotate(90, expand=False), Image.linear_gradient('L').resize((width, height))))
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=92)
+    return out.getvalue(), image
+
+
+class StandIn:
+    def __init__(self, original, image):
+        self.original = original
+        self.image = image
+        self.previews = {}
+        self.sent = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/index.php/core/preview':
+                    query = parse_qs(url.query)
+                    body = stand_in.preview(int(query['x'][0]), int(query['y'][0]))
+                else:
+                    body = stand_in.original
+                stand_in.sent += len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def preview(self, width, height):
+        if (width, height) not in self.previews:
+            image = self.image.copy()
+            image.thumbnail((width, height), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, 'JPEG', quality=90)
+            self.previews[width, height] = out.getvalue()
+        return self.previews[width, height]
+
+
+def bench(renditions, stand_in, source, runs):
+    renditions.SOURCE = source
+    times, sent = [], []
+    for _ in range(runs):
+        before = stand_in.sent
+        start = time.perf_counter()
+        # No etag: rendered every time instead of served from the cache
+        renditions.get_rendition('/photos/original.jpg', None, file_id='1')
+        times.append(time.perf_counter() - start)
+        sent.append(stand_in.sent - before)
+    return statistics.median(times), statistics.median(sent)
+
+
+def main():
+    original, image = make_original(MEGAPIXELS)
+    stand_in = StandIn(original, image)
+    os.environ['NC_URL'] = stand_in.url + '/remote.php/dav/files/bench'
+    os.environ['RENDITION_CACHE_DIR'] = tempfile.mkdtemp()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import renditions
+    stand_in.preview(*renditions.DISPLAY_SIZE)
+
+    print(f"{image.width}x{image.height} original, {len(original) / 1e6:.1f} MB, "
+          f"{RUNS} runs at {renditions.DISPLAY_SIZE[0]}x{renditions.DISPLAY_SIZE[1]}")
+    for source in ('original', 'preview'):
+        bench(renditions, stand_in, source, 1)  # warm-up: connection, worker pool
+        seconds, sent = bench(renditions, stand_in, source, RUNS)
+        print(f"{source:>8}: {seconds * 1000:7.0f} ms  {sent / 1e6:6.2f} MB transferred")
+    stand_in.server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
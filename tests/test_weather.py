@@ -0,0 +1,167 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import weather
+
+# Run with: python -m unittest discover tests
+#
+# The refresher against a local stand-in for Open-Meteo (http.server) and an in-memory
+# Redis, so neither the network nor a Redis server is needed.
+
+FORECAST = {
+    'current': {'temperature_2m': 21.4, 'weather_code': 0},
+    'daily': {'temperature_2m_max': [22.0, 18.6], 'temperature_2m_min': [12.0, 9.2], 'weather_code': [0, 61]},
+}
+
+
+class MemoryRedis:
+    # The few commands weather.py uses, with string values like decode_responses=True
+
+    def __init__(self):
+        self.data = {}
+        self.mutex = threading.Lock()
+
+    def get(self, key):
+        with self.mutex:
+            return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.mutex:
+            if nx and key in self.data:
+                return None
+            self.data[key] = str(value)
+            return True
+
+    def incr(self, key):
+        with self.mutex:
+            self.data[key] = str(int(self.data.get(key, 0)) + 1)
+            return int(self.data[key])
+
+    def delete(self, *keys):
+        with self.mutex:
+            return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    def __init__(self, r):
+        self.r, self.calls = r, []
+
+    def __getattr__(self, name):
+        method = getattr(self.r, name)
+        return lambda *args, **kwargs: self.calls.append((method, args, kwargs))
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+
+class StubServer:
+    # Answers every GET with status and the forecast; hold() keeps requests waiting
+
+    def __init__(self):
+        self.status = 200
+        self.requests = 0
+        self.received = threading.Event()
+        self.released = threading.Event()
+        self.released.set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                stub.received.set()
+                stub.released.wait(10)
+                body = json.dumps(FORECAST).encode() if stub.status == 200 else b'unavailable'
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1/forecast"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.released.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RefreshTest(unittest.TestCase):
+    NOW = 1_700_000_000
+
+    def setUp(self):
+        self.server = StubServer()
+        self.addCleanup(self.server.close)
+        patcher = mock.patch.object(weather, 'API_URL', self.server.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.r = MemoryRedis()
+
+    def test_fetches_and_caches(self):
+        self.assertTrue(weather.refresh(self.r, now=self.NOW))
+        self.assertEqual(weather.decode(self.r.get(weather.DATA_KEY), now=self.NOW),
+                         {'current': {'temp': 21, 'icon': '☀️'}, 'tomorrow': {'max': 19, 'min': 9, 'icon': '🌧️'}})
+        # Fresh data is not fetched again before REFRESH_INTERVAL
+        self.assertFalse(weather.refresh(self.r, now=self.NOW + weather.REFRESH_INTERVAL - 1))
+        self.assertEqual(self.server.requests, 1)
+
+    def test_single_flight(self):
+        self.server.released.clear()
+        results = []
+        first = threading.Thread(target=lambda: results.append(weather.refresh(self.r, now=self.NOW)))
+        first.start()
+        self.assertTrue(self.server.received.wait(10))
+        # A second process finds the lock taken and does not fetch
+        self.assertFalse(weather.refresh(self.r, now=self.NOW))
+        self.server.released.set()
+        first.join(10)
+        self.assertEqual(results, [True])
+        self.assertEqual(self.server.requests, 1)
+        self.assertIsNone(self.r.get(weather.LOCK_KEY))
+
+    def test_serves_stale_data_on_error(self):
+        weather.refresh(self.r, now=self.NOW)
+        raw = self.r.get(weather.DATA_KEY)
+        self.server.status = 503
+        later = self.NOW + weather.REFRESH_INTERVAL + 1
+        self.assertFalse(weather.refresh(self.r, now=later))
+        self.assertEqual(self.server.requests, 2)
+        # The previous forecast stays in place and is shown until MAX_STALE
+        self.assertEqual(self.r.get(weather.DATA_KEY), raw)
+        self.assertIsNotNone(weather.decode(raw, now=later))
+        self.assertIsNone(weather.decode(raw, now=self.NOW + weather.MAX_STALE + 1))
+
+    def test_backoff_grows_until_capped(self):
+        self.server.status = 503
+        now, delays = self.NOW, []
+        with mock.patch.object(weather.random, 'uniform', return_value=1.0):
+            for _ in range(8):
+                self.assertFalse(weather.refresh(self.r, now=now))
+                retry_at = float(self.r.get(weather.RETRY_KEY))
+                delays.append(retry_at - now)
+                # Nothing is fetched until the retry time
+                requests = self.server.requests
+                self.assertFalse(weather.refresh(self.r, now=retry_at - 1))
+                self.assertEqual(self.server.requests, requests)
+                now = retry_at
+        self.assertEqual(delays, [60, 120, 240, 480, 960, 1920, 3600, 3600])
+
+        # A success resets the backoff
+        self.server.status = 200
+        self.assertTrue(weather.refresh(self.r, now=now))
+        self.assertIsNone(self.r.get(weather.FAILURES_KEY))
+        self.assertIsNone(self.r.get(weather.RETRY_KEY))
+
+
+if __name__ == '__main__':
+    unittest.main()
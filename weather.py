@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import requests
+
+# Weather for the overlay, kept fresh by a background refresher in the worker.
+#
+# The app only reads weather:data. The refresher fetches Open-Meteo every
+# REFRESH_INTERVAL seconds; until a fetch succeeds the previous data stays in place
+# (stale-while-revalidate), up to MAX_STALE. A Redis lock makes sure only one
+# process fetches at a time, and failures back off exponentially.
+
+LAT = os.getenv('WEATHER_LAT')
+LON = os.getenv('WEATHER_LON')
+API_URL = os.getenv('WEATHER_API_URL', 'https://api.open-meteo.com/v1/forecast')
+
+REFRESH_INTERVAL = 900
+MAX_STALE = 6 * 3600
+TIMEOUT = 5
+LOCK_TTL = 30
+BACKOFF_MIN = 60
+BACKOFF_MAX = 3600
+
+DATA_KEY = "weather:data"
+LOCK_KEY = "weather:lock"
+FAILURES_KEY = "weather:failures"
+RETRY_KEY = "weather:retry_at"
+
+session = requests.Session()
+
+
+def enabled():
+    return bool(LAT and LON)
+
+
+def get_icon(code):
+    # WMO Weather Codes mapping (simplified)
+    if code == 0: return "☀️"
+    if code in [1,2,3]: return "⛅"
+    if code in [45,48]: return "🌫️"
+    if code in [51,53,55,61,63,65]: return "🌧️"
+    if code in [71,73,75,77]: return "❄️"
+    if code in [95,96,99]: return "⛈️"
+    return "🌡️"
+
+
+def parse(w):
+    return {
+        'current': {'temp': round(w['current']['temperature_2m']), 'icon': get_icon(w['current']['weather_code'])},
+        'tomorrow': {
+            'max': round(w['daily']['temperature_2m_max'][1]),
+            'min': round(w['daily']['temperature_2m_min'][1]),
+            'icon': get_icon(w['daily']['weather_code'][1]),
+        },
+    }
+
+
+def decode(raw, now=None):
+    # Cached JSON (weather:data, read by the app) -> overlay data, None when missing or too old to show
+    if not raw:
+        return None
+    try:
+        cached = json.loads(raw)
+    except ValueError:
+        return None
+    if (now or time.time()) - cached.get('fetched_at', 0) > MAX_STALE:
+        return None
+    return cached.get('weather')
+
+
+def fetch():
+    params = {
+        'latitude': LAT,
+        'longitude': LON,
+        'current': 'temperature_2m,weather_code',
+        'daily': 'weather_code,temperature_2m_max,temperature_2m_min',
+        'timezone': 'auto',
+        'forecast_days': 2,
+    }
+    resp = session.get(API_URL, params=params, timeout=TIMEOUT)
+    resp.raise_for_status()
+    return parse(resp.json())
+
+
+def refresh(r, now=None):
+    # Fetch new data if it is due and no other process is already fetching.
+    # Returns True if the cache was updated.
+    now = now or time.time()
+    pipe = r.pipeline(transaction=False)
+    pipe.get(DATA_KEY)
+    pipe.get(RETRY_KEY)
+    raw, retry_at = pipe.execute()
+    if raw:
+        try:
+            if now - json.loads(raw).get('fetched_at', 0) < REFRESH_INTERVAL:
+                return False
+        except ValueError:
+            pass
+    if retry_at and now < float(retry_at):
+        return False
+
+    token = uuid.uuid4().hex
+    if not r.set(LOCK_KEY, token, nx=True, ex=LOCK_TTL):
+        return False
+    try:
+        weather = fetch()
+        pipe = r.pipeline(transaction=False)
+        pipe.set(DATA_KEY, json.dumps({'weather': weather, 'fetched_at': now}))
+        pipe.delete(FAILURES_KEY, RETRY_KEY)
+        pipe.execute()
+        return True
+    except Exception as e:
+        failures = r.incr(FAILURES_KEY)
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (failures - 1)) * random.uniform(0.8, 1.2)
+        r.set(RETRY_KEY, now + delay)
+        print(f"Weather error: {e} (retrying in {int(delay)}s)", file=sys.stderr)
+        return False
+    finally:
+        # Release only our own lock
+        if r.get(LOCK_KEY) == token:
+            r.delete(LOCK_KEY)
+
+
+def refresher(r, interval=60):
+    # Background loop for the worker; checks every interval seconds whether a refresh is due
+    while True:
+        try:
+            refresh(r)
+        except Exception as e:
+            print(f"Weather refresher error: {e}", file=sys.stderr)
+        time.sleep(interval)